@@ -0,0 +1,161 @@
+"""
+Admission control cho các endpoint nặng
+
+Giới hạn số request xử lý đồng thời và tổng số bytes đang giữ trong bộ nhớ
+cho từng endpoint. Request vượt giới hạn được chờ trong hàng đợi ngắn,
+hàng đợi đầy hoặc chờ quá lâu thì bị từ chối ngay (503 + Retry-After)
+thay vì làm container hết bộ nhớ hoặc dồn ứ sau Graph throttling.
+Giới hạn áp dụng trong từng worker process.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import Dict
+
+
+class AdmissionRejected(Exception):
+    """Request bị từ chối do endpoint đang quá tải"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class AdmissionSlot:
+    """Slot của một request đã được nhận, giữ số bytes đang tính cho request đó"""
+
+    def __init__(self, limiter: 'AdmissionLimiter', nbytes: int):
+        self.limiter = limiter
+        self.nbytes = nbytes
+
+    async def reserve(self, nbytes: int) -> None:
+        """
+        Tính thêm bytes cho request khi handler biết sẽ giữ thêm dữ liệu trong bộ nhớ
+        (ví dụ file đính kèm lấy từ cache), trả lại cùng slot khi request kết thúc
+
+        Raises:
+            AdmissionRejected: Nếu thêm bytes sẽ vượt max_inflight_bytes
+        """
+        await self.limiter._reserve(self, nbytes)
+
+
+class AdmissionLimiter:
+    """Giới hạn concurrency và in-flight bytes cho một endpoint"""
+
+    def __init__(self, name: str, max_concurrent: int, max_inflight_bytes: int = 0,
+                 max_queue: int = 0, queue_timeout: float = 0, retry_after: int = 5,
+                 default_request_bytes: int = 0):
+        """
+        Args:
+            name: Tên endpoint (dùng cho metrics)
+            max_concurrent: Số request xử lý đồng thời tối đa
+            max_inflight_bytes: Tổng bytes request đang xử lý tối đa (0 = không giới hạn)
+            max_queue: Số request được phép chờ (0 = từ chối ngay khi đầy)
+            queue_timeout: Thời gian chờ tối đa trong hàng đợi (giây)
+            retry_after: Giá trị header Retry-After khi từ chối (giây)
+            default_request_bytes: Số bytes tính cho request không có Content-Length
+                                   (ví dụ upload chunked)
+        """
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_inflight_bytes = max_inflight_bytes
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.default_request_bytes = default_request_bytes
+
+        self.in_flight = 0
+        self.inflight_bytes = 0
+        self.waiting = 0
+        self._condition = asyncio.Condition()
+
+        # Metrics
+        self.admitted_count = 0
+        self.rejected_count = 0
+        self.total_queue_time = 0.0
+        self.max_queue_time = 0.0
+
+    def _can_admit(self, nbytes: int) -> bool:
+        """Kiểm tra còn slot và còn đủ bytes cho request"""
+        if self.in_flight >= self.max_concurrent:
+            return False
+        if self.max_inflight_bytes and self.in_flight > 0:
+            # Khi không có request nào đang chạy thì luôn cho qua,
+            # tránh request lớn hơn giới hạn bị chặn vĩnh viễn
+            return self.inflight_bytes + nbytes <= self.max_inflight_bytes
+        return True
+
+    def _reject(self, reason: str):
+        self.rejected_count += 1
+        raise AdmissionRejected(f"{self.name} đang quá tải ({reason}), vui lòng thử lại sau", self.retry_after)
+
+    @asynccontextmanager
+    async def acquire(self, nbytes: int = 0):
+        """
+        Giữ một slot trong suốt thời gian xử lý request
+
+        Args:
+            nbytes: Số bytes request sẽ giữ trong bộ nhớ (ước lượng từ Content-Length)
+
+        Yields:
+            AdmissionSlot để handler tính thêm bytes trong lúc xử lý
+
+        Raises:
+            AdmissionRejected: Nếu hàng đợi đầy hoặc chờ quá queue_timeout
+        """
+        start = time.monotonic()
+
+        async with self._condition:
+            if not self._can_admit(nbytes):
+                if self.waiting >= self.max_queue:
+                    self._reject("hàng đợi đầy")
+
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(lambda: self._can_admit(nbytes)),
+                        timeout=self.queue_timeout
+                    )
+                except asyncio.TimeoutError:
+                    self._reject("chờ quá lâu")
+                finally:
+                    self.waiting -= 1
+
+            self.in_flight += 1
+            self.inflight_bytes += nbytes
+
+        queue_time = time.monotonic() - start
+        self.admitted_count += 1
+        self.total_queue_time += queue_time
+        self.max_queue_time = max(self.max_queue_time, queue_time)
+
+        slot = AdmissionSlot(self, nbytes)
+        try:
+            yield slot
+        finally:
+            async with self._condition:
+                self.in_flight -= 1
+                self.inflight_bytes -= slot.nbytes
+                self._condition.notify_all()
+
+    async def _reserve(self, slot: AdmissionSlot, nbytes: int) -> None:
+        """Tính thêm bytes cho slot đang giữ, không chờ để tránh deadlock giữa các slot"""
+        async with self._condition:
+            if (self.max_inflight_bytes and self.in_flight > 1
+                    and self.inflight_bytes + nbytes > self.max_inflight_bytes):
+                # Chỉ có request này đang chạy thì vẫn cho qua, giống _can_admit
+                self._reject("vượt giới hạn bytes")
+            self.inflight_bytes += nbytes
+            slot.nbytes += nbytes
+
+    def metrics(self) -> Dict:
+        """Thống kê hiện tại của limiter"""
+        return {
+            "inFlight": self.in_flight,
+            "inFlightBytes": self.inflight_bytes,
+            "waiting": self.waiting,
+            "admitted": self.admitted_count,
+            "rejected": self.rejected_count,
+            "avgQueueTimeMs": round(self.total_queue_time / self.admitted_count * 1000, 2) if self.admitted_count else 0,
+            "maxQueueTimeMs": round(self.max_queue_time * 1000, 2)
+        }
@@ -0,0 +1,157 @@
+"""
+Cache file đính kèm đã encode base64, dùng lại giữa các request
+
+Key là SHA-256 của nội dung file nên cùng một file gửi nhiều lần chỉ encode một lần.
+Cache lưu trên đĩa (mỗi file một cặp <sha256>.b64 + <sha256>.json) trong thư mục
+dùng chung giữa các worker, nên attachmentRefs dùng được dù request rơi vào worker nào.
+Cache giới hạn theo tổng số bytes, vượt giới hạn thì loại bỏ entry ít dùng nhất
+(LRU theo mtime, được cập nhật mỗi lần đọc).
+
+Các hàm đọc/ghi file và encode là blocking, gọi qua asyncio.to_thread trong handler async.
+"""
+import base64
+import hashlib
+import json
+import os
+import re
+import tempfile
+from typing import Dict, Optional
+from config import ATTACHMENT_CACHE_DIR, ATTACHMENT_CACHE_MAX_BYTES
+
+_SHA256_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+
+class AttachmentCache:
+    """LRU cache nội dung base64 của file đính kèm trên đĩa, giới hạn theo bytes"""
+
+    def __init__(self, cache_dir: str = ATTACHMENT_CACHE_DIR, max_bytes: int = ATTACHMENT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, sha256: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f"{sha256}{suffix}")
+
+    def _write_atomic(self, path: str, data: str) -> None:
+        """Ghi file tạm rồi rename để worker khác không đọc phải file ghi dở"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def add(self, content: bytes, filename: str, content_type: str) -> Dict:
+        """
+        Encode file (hoặc lấy từ cache nếu đã có) và lưu vào cache
+
+        Args:
+            content: Nội dung file
+            filename: Tên file
+            content_type: MIME type của file
+
+        Returns:
+            Entry dạng {"sha256", "filename", "content_type", "size", "content_base64"}
+        """
+        sha256 = hashlib.sha256(content).hexdigest()
+
+        entry = self.get(sha256)
+        if entry:
+            # Cùng nội dung nhưng có thể khác tên file / content type
+            return {**entry, "filename": filename, "content_type": content_type}
+
+        entry = {
+            "sha256": sha256,
+            "filename": filename,
+            "content_type": content_type,
+            "size": len(content),
+            "content_base64": base64.b64encode(content).decode('utf-8')
+        }
+
+        if len(entry["content_base64"]) > self.max_bytes:
+            # File lớn hơn cả cache → không lưu
+            return entry
+
+        # Ghi nội dung trước, metadata sau: get() chỉ coi là hit khi có metadata
+        self._write_atomic(self._path(sha256, '.b64'), entry["content_base64"])
+        metadata = {key: entry[key] for key in ("filename", "content_type", "size")}
+        self._write_atomic(self._path(sha256, '.json'), json.dumps(metadata, ensure_ascii=False))
+
+        self._evict()
+        return entry
+
+    def get(self, sha256: str) -> Optional[Dict]:
+        """
+        Lấy entry theo SHA-256, đánh dấu là vừa được dùng
+
+        Returns:
+            Entry nếu có trong cache, None nếu không (hoặc sha256 không hợp lệ)
+        """
+        sha256 = sha256.lower()
+        if not _SHA256_PATTERN.fullmatch(sha256):
+            return None
+
+        try:
+            with open(self._path(sha256, '.json'), 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            with open(self._path(sha256, '.b64'), 'r', encoding='utf-8') as f:
+                content_base64 = f.read()
+            os.utime(self._path(sha256, '.b64'))
+        except (FileNotFoundError, ValueError):
+            # Chưa có hoặc vừa bị worker khác evict
+            return None
+
+        return {"sha256": sha256, **metadata, "content_base64": content_base64}
+
+    def content_size(self, sha256: str) -> Optional[int]:
+        """
+        Kích thước nội dung base64 của entry mà không đọc file
+
+        Returns:
+            Số bytes nếu có trong cache, None nếu không (hoặc sha256 không hợp lệ)
+        """
+        sha256 = sha256.lower()
+        if not _SHA256_PATTERN.fullmatch(sha256):
+            return None
+        try:
+            return os.path.getsize(self._path(sha256, '.b64'))
+        except FileNotFoundError:
+            return None
+
+    def _evict(self) -> None:
+        """Xóa entry ít dùng nhất cho đến khi tổng dung lượng không vượt max_bytes"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.b64'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name[:-len('.b64')]))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, sha256 in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            # Xóa metadata trước để get() không trả về entry thiếu nội dung
+            for suffix in ('.json', '.b64'):
+                try:
+                    os.remove(self._path(sha256, suffix))
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+
+    def total_bytes(self) -> int:
+        """Tổng dung lượng nội dung base64 đang cache"""
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.b64'):
+                try:
+                    total += os.path.getsize(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    pass
+        return total
@@ -0,0 +1,117 @@
+"""
+Circuit breaker cho các call tới Microsoft Graph
+
+Khi tỉ lệ lỗi trong cửa sổ thời gian gần nhất vượt ngưỡng, breaker chuyển sang
+trạng thái open và các call tiếp theo fail fast (không chờ Graph) trong
+open_seconds. Hết thời gian đó breaker cho một call thử (half-open):
+thành công thì đóng lại, thất bại thì mở tiếp.
+"""
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+
+class CircuitOpenError(Exception):
+    """Breaker đang mở, call bị từ chối ngay"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Circuit breaker theo tỉ lệ lỗi trong cửa sổ thời gian trượt"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, error_rate_threshold: float, min_requests: int,
+                 window_seconds: float, open_seconds: float):
+        """
+        Args:
+            name: Tên breaker (dùng trong message lỗi)
+            error_rate_threshold: Tỉ lệ lỗi (0.0 - 1.0) để mở breaker
+            min_requests: Số call tối thiểu trong cửa sổ trước khi xét tỉ lệ lỗi
+            window_seconds: Độ dài cửa sổ thời gian tính tỉ lệ lỗi
+            open_seconds: Thời gian giữ breaker open trước khi cho call thử
+        """
+        self.name = name
+        self.error_rate_threshold = error_rate_threshold
+        self.min_requests = min_requests
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._results = deque()  # (timestamp, success)
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    def _retry_after(self, now: float) -> int:
+        return max(1, int(self.opened_at + self.open_seconds - now + 0.999))
+
+    def before_call(self) -> None:
+        """
+        Kiểm tra trước mỗi call
+
+        Raises:
+            CircuitOpenError: Nếu breaker đang open hoặc đang có call thử
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+
+            if self.state == self.OPEN and now - self.opened_at >= self.open_seconds:
+                self.state = self.HALF_OPEN
+                self._trial_in_progress = False
+
+            if self.state == self.HALF_OPEN and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return
+
+            raise CircuitOpenError(
+                f"Graph API đang lỗi, tạm ngừng gọi {self.name} (circuit breaker open)",
+                self._retry_after(now)
+            )
+
+    def record(self, success: bool) -> None:
+        """Ghi nhận kết quả một call"""
+        now = time.monotonic()
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_in_progress = False
+                if success:
+                    self.state = self.CLOSED
+                    self._results.clear()
+                else:
+                    self.state = self.OPEN
+                    self.opened_at = now
+                return
+
+            if self.state == self.OPEN:
+                # Kết quả muộn của call bắt đầu trước khi breaker mở
+                return
+
+            self._results.append((now, success))
+            while self._results and now - self._results[0][0] > self.window_seconds:
+                self._results.popleft()
+
+            total = len(self._results)
+            failures = sum(1 for _, ok in self._results if not ok)
+            if total >= self.min_requests and failures / total >= self.error_rate_threshold:
+                self.state = self.OPEN
+                self.opened_at = now
+
+    def metrics(self) -> Dict:
+        """Trạng thái hiện tại của breaker"""
+        with self._lock:
+            total = len(self._results)
+            failures = sum(1 for _, ok in self._results if not ok)
+            return {
+                "state": self.state,
+                "windowRequests": total,
+                "windowFailures": failures
+            }
@@ -3,6 +3,8 @@ Module cấu hình cho ứng dụng email processor
 """
 import os
 import html
+import re
+import tempfile
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -28,10 +30,72 @@ def load_email_format():
 EMAIL_FORMAT = load_email_format()
 
 # Microsoft Graph API endpoints
-GRAPH_API_ENDPOINT = 'https://graph.microsoft.com/v1.0'
+# Có thể trỏ sang server giả lập (fake_graph_server.py) để test fault injection
+GRAPH_API_ENDPOINT = os.getenv('GRAPH_API_ENDPOINT', 'https://graph.microsoft.com/v1.0')
 AUTHORITY = f'https://login.microsoftonline.com/{TENANT_ID}'
 SCOPE = ['https://graph.microsoft.com/.default']
 
+# Lease message giữa các worker/container trên cùng host (SQLite, WAL mode)
+# Các container trên cùng host muốn dùng chung lease cần mount chung thư mục local chứa file DB;
+# không dùng volume mạng (NFS...) giữa nhiều host vì SQLite WAL không hỗ trợ network filesystem
+# Lease được gia hạn trước mỗi message nên TTL chỉ cần đủ cho xử lý một message
+# (lấy attachments có retry + đánh dấu đã đọc, tối đa khoảng 1-2 phút với timeout mặc định)
+LEASE_DB_PATH = os.getenv('LEASE_DB_PATH', os.path.join(tempfile.gettempdir(), 'email_message_leases.db'))
+LEASE_TTL_SECONDS = int(os.getenv('LEASE_TTL_SECONDS', '300'))
+
+# Khoảng cách tối thiểu giữa các lần /ready thử warm-up lại (giây)
+READY_RETRY_INTERVAL_SECONDS = float(os.getenv('READY_RETRY_INTERVAL_SECONDS', '30'))
+
+# Tự động archive email sau khi xử lý (để trống = không archive)
+# Giá trị là tên thư mục (tự tạo nếu chưa có), folder id hoặc well-known name (archive, deleteditems...)
+ARCHIVE_PROCESSED_FOLDER = os.getenv('ARCHIVE_PROCESSED_FOLDER', '')
+ARCHIVE_REJECTED_FOLDER = os.getenv('ARCHIVE_REJECTED_FOLDER', '')
+
+# Thư mục được poll email đến (ví dụ: inbox)
+# Để trống = tất cả thư mục của mailbox, trừ khi bật archive: khi đó mặc định là inbox,
+# vì poll tất cả thư mục thì email đã archive vẫn bị quét lại
+MAIL_POLL_FOLDER = os.getenv('MAIL_POLL_FOLDER') or (
+    'inbox' if ARCHIVE_PROCESSED_FOLDER or ARCHIVE_REJECTED_FOLDER else ''
+)
+# Graph $batch tối đa 20 request mỗi batch
+ARCHIVE_BATCH_SIZE = min(int(os.getenv('ARCHIVE_BATCH_SIZE', '20')), 20)
+
+# Cache file đính kèm đã encode base64 trên đĩa, dùng chung giữa các worker
+# (mặc định nằm cạnh file lease DB; replica muốn dùng chung cần mount chung thư mục)
+ATTACHMENT_CACHE_DIR = os.getenv('ATTACHMENT_CACHE_DIR', os.path.join(os.path.dirname(LEASE_DB_PATH), 'email_attachment_cache'))
+ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv('ATTACHMENT_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+
+# Logging: level (DEBUG, INFO, WARNING, ERROR) và tỉ lệ giữ log theo từng message (0.0 - 1.0)
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '1.0'))
+
+# Tổng kích thước file đính kèm tối đa mỗi email (giới hạn của Graph API)
+MAX_ATTACHMENT_BYTES = 25 * 1024 * 1024
+
+# Admission control cho endpoint nặng (mỗi worker)
+SEND_MAX_CONCURRENT = int(os.getenv('SEND_MAX_CONCURRENT', '4'))
+SEND_MAX_INFLIGHT_BYTES = int(os.getenv('SEND_MAX_INFLIGHT_BYTES', str(100 * 1024 * 1024)))
+SEND_MAX_QUEUE = int(os.getenv('SEND_MAX_QUEUE', '8'))
+RECEIVE_MAX_CONCURRENT = int(os.getenv('RECEIVE_MAX_CONCURRENT', '2'))
+RECEIVE_MAX_QUEUE = int(os.getenv('RECEIVE_MAX_QUEUE', '4'))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv('ADMISSION_QUEUE_TIMEOUT_SECONDS', '2'))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', '5'))
+
+# Timeout cho call tới Graph (giây): connect, đọc (GET/PATCH/move), gửi email (upload tới 25MB)
+GRAPH_CONNECT_TIMEOUT = float(os.getenv('GRAPH_CONNECT_TIMEOUT', '5'))
+GRAPH_READ_TIMEOUT = float(os.getenv('GRAPH_READ_TIMEOUT', '15'))
+GRAPH_SEND_TIMEOUT = float(os.getenv('GRAPH_SEND_TIMEOUT', '60'))
+
+# Circuit breaker: mở khi tỉ lệ lỗi trong cửa sổ vượt ngưỡng, fail fast trong OPEN_SECONDS
+GRAPH_BREAKER_ERROR_RATE = float(os.getenv('GRAPH_BREAKER_ERROR_RATE', '0.5'))
+GRAPH_BREAKER_MIN_REQUESTS = int(os.getenv('GRAPH_BREAKER_MIN_REQUESTS', '10'))
+GRAPH_BREAKER_WINDOW_SECONDS = float(os.getenv('GRAPH_BREAKER_WINDOW_SECONDS', '30'))
+GRAPH_BREAKER_OPEN_SECONDS = float(os.getenv('GRAPH_BREAKER_OPEN_SECONDS', '30'))
+
+# Hedged request cho GET idempotent: gửi request thứ hai nếu request đầu chưa xong sau HEDGE_DELAY_MS (0 = tắt)
+GRAPH_HEDGE_DELAY_MS = int(os.getenv('GRAPH_HEDGE_DELAY_MS', '0'))
+GRAPH_HEDGE_MAX_WORKERS = int(os.getenv('GRAPH_HEDGE_MAX_WORKERS', '8'))
+
 
 def generate_email_body(information: dict) -> str:
     """
@@ -68,25 +132,10 @@ def generate_email_body(information: dict) -> str:
     return body
 
 
-def parse_email_body(body_content: str) -> dict:
-    """
-    Parse email body để extract thông tin theo format template
-    
-    Args:
-        body_content: Nội dung email body (HTML hoặc text)
-    
-    Returns:
-        Dict chứa thông tin đã parse, hoặc None nếu không match format
-    """
-    import re
-    
-    # Unescape HTML nếu có (chuyển &lt; thành <, &gt; thành >)
-    body_text = html.unescape(body_content)
-    
-    # QUAN TRỌNG: KHÔNG remove tất cả HTML tags vì sẽ mất <DOC>, <DOCNUMBER>
-    # Chỉ loại bỏ các HTML tags CỤ THỂ, giữ lại XML tags
-    # Remove common HTML tags: html, head, body, pre, div, span, p, meta, style
-    html_tags_to_remove = [
+# Các HTML tags CỤ THỂ cần loại bỏ khi parse, giữ lại XML tags <DOC>, <DOCNUMBER>...
+# Compile sẵn một lần khi load module thay vì mỗi lần parse
+_HTML_TAG_PATTERNS = [
+    re.compile(pattern, re.IGNORECASE | re.DOTALL) for pattern in [
         r'<html[^>]*>',
         r'</html>',
         r'<head[^>]*>',
@@ -106,19 +155,11 @@ def parse_email_body(body_content: str) -> dict:
         r'\\r',
         r'\\n'
     ]
-    
-    for pattern in html_tags_to_remove:
-        body_text = re.sub(pattern, '', body_text, flags=re.IGNORECASE | re.DOTALL)
-    
-    # Kiểm tra có chứa <DOC> không
-    if '<DOC>' not in body_text or '</DOC>' not in body_text:
-        return None
-    
-    # Parse từng field
-    result = {}
-    
-    # Định nghĩa các pattern để extract
-    patterns = {
+]
+
+# Pattern để extract từng field
+_FIELD_PATTERNS = {
+    field: re.compile(pattern, re.DOTALL | re.IGNORECASE) for field, pattern in {
         'docNumber': r'<DOCNUMBER>(.*?)</DOCNUMBER>',
         'docTime': r'<DOCTIME>(.*?)</DOCTIME>',
         'docSigner': r'<DOCSIGNER>(.*?)</DOCSIGNER>',
@@ -128,11 +169,38 @@ def parse_email_body(body_content: str) -> dict:
         'docSecurity': r'<DOCSECURITY>(.*?)</DOCSECURITY>',
         'docId': r'<DOCID>(.*?)</DOCID>',
         'returnEmail': r'<RETURN-EMAIL>(.*?)</RETURN-EMAIL>'
-    }
+    }.items()
+}
+
+
+def parse_email_body(body_content: str) -> dict:
+    """
+    Parse email body để extract thông tin theo format template
+    
+    Args:
+        body_content: Nội dung email body (HTML hoặc text)
+    
+    Returns:
+        Dict chứa thông tin đã parse, hoặc None nếu không match format
+    """
+    # Unescape HTML nếu có (chuyển &lt; thành <, &gt; thành >)
+    body_text = html.unescape(body_content)
+    
+    # QUAN TRỌNG: KHÔNG remove tất cả HTML tags vì sẽ mất <DOC>, <DOCNUMBER>
+    # Chỉ loại bỏ các HTML tags CỤ THỂ, giữ lại XML tags
+    for pattern in _HTML_TAG_PATTERNS:
+        body_text = pattern.sub('', body_text)
+    
+    # Kiểm tra có chứa <DOC> không
+    if '<DOC>' not in body_text or '</DOC>' not in body_text:
+        return None
+    
+    # Parse từng field
+    result = {}
     
     # Extract từng field
-    for field, pattern in patterns.items():
-        match = re.search(pattern, body_text, re.DOTALL | re.IGNORECASE)
+    for field, pattern in _FIELD_PATTERNS.items():
+        match = pattern.search(body_text)
         if match:
             result[field] = match.group(1).strip()
         else:
@@ -145,3 +213,15 @@ def parse_email_body(body_content: str) -> dict:
     
     return result
 
+
+def warm_up_templates() -> bool:
+    """
+    Chạy thử generate + parse với dữ liệu mẫu để kiểm tra template
+
+    Returns:
+        True nếu email tạo từ template parse lại được
+    """
+    sample = {'docNumber': 'WARMUP'}
+    body = f"<pre>{generate_email_body(sample)}</pre>"
+    parsed = parse_email_body(body)
+    return bool(parsed) and parsed.get('docNumber') == 'WARMUP'
@@ -0,0 +1,194 @@
+"""
+Server giả lập Microsoft Graph API có fault injection, dùng để kiểm tra
+timeout, circuit breaker và hedged request ở máy local
+
+Chạy server:
+    FAULT_ERROR_RATE=0.5 FAULT_SLOW_RATE=0.2 python fake_graph_server.py
+
+Trỏ GraphService tới server (token đặt sẵn để bỏ qua MSAL):
+    GRAPH_API_ENDPOINT=http://localhost:8001/v1.0 GRAPH_HEDGE_DELAY_MS=200 python
+    >>> import time
+    >>> from graph_service import GraphService
+    >>> service = GraphService()
+    >>> service.access_token, service.token_expiry = 'fake', time.time() + 3600
+    >>> service.get_unread_messages('user@example.com')
+    >>> service.breaker.metrics()
+
+Biến môi trường:
+    FAKE_GRAPH_PORT: Port lắng nghe (mặc định 8001)
+    FAULT_ERROR_RATE: Tỉ lệ request trả về 503 (0.0 - 1.0)
+    FAULT_LATENCY_MS: Độ trễ thêm cho mọi request
+    FAULT_SLOW_RATE: Tỉ lệ request bị treo FAULT_SLOW_MS (giả lập Graph chậm)
+    FAULT_SLOW_MS: Thời gian treo (mặc định 30000)
+    FAULT_SLOW_FIRST: Số request đầu tiên luôn bị treo FAULT_SLOW_MS (dùng cho test cần kết quả xác định)
+"""
+import base64
+import json
+import os
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from config import generate_email_body
+
+PORT = int(os.getenv('FAKE_GRAPH_PORT', '8001'))
+FAULT_ERROR_RATE = float(os.getenv('FAULT_ERROR_RATE', '0'))
+FAULT_LATENCY_MS = int(os.getenv('FAULT_LATENCY_MS', '0'))
+FAULT_SLOW_RATE = float(os.getenv('FAULT_SLOW_RATE', '0'))
+FAULT_SLOW_MS = int(os.getenv('FAULT_SLOW_MS', '30000'))
+FAULT_SLOW_FIRST = int(os.getenv('FAULT_SLOW_FIRST', '0'))
+
+WELL_KNOWN_FOLDERS = {'archive', 'deleteditems', 'drafts', 'inbox', 'junkemail', 'sentitems'}
+
+_lock = threading.Lock()
+_messages = {}
+_folders = {}
+_request_count = 0
+
+
+def _seed_messages(count: int = 5):
+    """Tạo sẵn một số email công văn chưa đọc, mỗi email có một file đính kèm"""
+    for index in range(count):
+        message_id = f"msg-{index}"
+        body = generate_email_body({'docNumber': f"{index}/CV", 'docId': f"CV-{index}"})
+        _messages[message_id] = {
+            'id': message_id,
+            'subject': f"Công văn số {index}",
+            'from': {'emailAddress': {'address': 'sender@example.com'}},
+            'receivedDateTime': '2024-01-15T10:30:00Z',
+            'bodyPreview': '',
+            'body': {'contentType': 'html', 'content': f"<pre>{body}</pre>"},
+            'isRead': False,
+            'attachments': [{
+                '@odata.type': '#microsoft.graph.fileAttachment',
+                'name': f"cong-van-{index}.txt",
+                'contentType': 'text/plain',
+                'size': 11,
+                'contentBytes': base64.b64encode(b'hello world').decode('utf-8')
+            }]
+        }
+
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+    """Xử lý các endpoint Graph mà GraphService sử dụng"""
+
+    def _inject_faults(self) -> bool:
+        """Áp dụng độ trễ/treo/lỗi, trả về True nếu đã trả lỗi"""
+        global _request_count
+        with _lock:
+            _request_count += 1
+            request_number = _request_count
+
+        if FAULT_LATENCY_MS:
+            time.sleep(FAULT_LATENCY_MS / 1000)
+        if request_number <= FAULT_SLOW_FIRST or random.random() < FAULT_SLOW_RATE:
+            time.sleep(FAULT_SLOW_MS / 1000)
+        if random.random() < FAULT_ERROR_RATE:
+            self._reply(503, {'error': {'code': 'ServiceUnavailable', 'message': 'Injected fault'}})
+            return True
+        return False
+
+    def _reply(self, status: int, data=None):
+        payload = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        if self._inject_faults():
+            return
+        path = urlparse(self.path).path
+
+        if re.fullmatch(r'/v1.0/users/[^/]+(/mailFolders/[^/]+)?/messages', path):
+            with _lock:
+                unread = [
+                    {k: v for k, v in message.items() if k != 'attachments'}
+                    for message in _messages.values() if not message['isRead']
+                ]
+            return self._reply(200, {'value': unread})
+
+        match = re.fullmatch(r'/v1.0/users/[^/]+/messages/([^/]+)/attachments', path)
+        if match:
+            message = _messages.get(match.group(1))
+            if not message:
+                return self._reply(404, {'error': {'code': 'ErrorItemNotFound'}})
+            return self._reply(200, {'value': message['attachments']})
+
+        if re.fullmatch(r'/v1.0/users/[^/]+/mailFolders/[^/]+', path):
+            folder_id = unquote(path.rsplit('/', 1)[-1])
+            with _lock:
+                exists = folder_id.lower() in WELL_KNOWN_FOLDERS or folder_id in _folders.values()
+            if not exists:
+                return self._reply(404, {'error': {'code': 'ErrorItemNotFound'}})
+            return self._reply(200, {'id': folder_id})
+
+        if re.fullmatch(r'/v1.0/users/[^/]+/mailFolders', path):
+            # Chỉ hỗ trợ $filter=displayName eq '<tên>' mà GraphService dùng
+            query_filter = parse_qs(urlparse(self.path).query).get('$filter', [''])[0]
+            match = re.search(r"displayName eq '((?:[^']|'')*)'", query_filter)
+            with _lock:
+                folders = [
+                    {'id': folder_id, 'displayName': name} for name, folder_id in _folders.items()
+                    if not match or name == match.group(1).replace("''", "'")
+                ]
+            return self._reply(200, {'value': folders})
+
+        self._reply(404, {'error': {'code': 'NotFound'}})
+
+    def do_PATCH(self):
+        if self._inject_faults():
+            return
+        match = re.fullmatch(r'/v1.0/users/[^/]+/messages/([^/]+)', urlparse(self.path).path)
+        data = self._read_json()
+        with _lock:
+            message = _messages.get(match.group(1)) if match else None
+            if not message:
+                return self._reply(404, {'error': {'code': 'ErrorItemNotFound'}})
+            message['isRead'] = data.get('isRead', message['isRead'])
+        self._reply(200, {'id': message['id']})
+
+    def do_POST(self):
+        if self._inject_faults():
+            return
+        path = urlparse(self.path).path
+        data = self._read_json()
+
+        if re.fullmatch(r'/v1.0/users/[^/]+/sendMail', path):
+            return self._reply(202)
+
+        if re.fullmatch(r'/v1.0/users/[^/]+/mailFolders', path):
+            name = data.get('displayName', 'folder')
+            with _lock:
+                if name in _folders:
+                    return self._reply(409, {'error': {'code': 'ErrorFolderExists'}})
+                _folders[name] = name
+            return self._reply(201, {'id': name})
+
+        if path == '/v1.0/$batch':
+            responses = []
+            with _lock:
+                for item in data.get('requests', []):
+                    message_id = item['url'].split('/messages/')[1].split('/')[0]
+                    status = 201 if _messages.pop(message_id, None) else 404
+                    responses.append({'id': item['id'], 'status': status, 'body': {}})
+            return self._reply(200, {'responses': responses})
+
+        self._reply(404, {'error': {'code': 'NotFound'}})
+
+    def log_message(self, format, *args):
+        print(f"[fake-graph] {self.command} {self.path} - {format % args}")
+
+
+if __name__ == "__main__":
+    _seed_messages()
+    server = ThreadingHTTPServer(('0.0.0.0', PORT), FakeGraphHandler)
+    print(f"🧪 Fake Graph API chạy tại http://localhost:{PORT}/v1.0")
+    server.serve_forever()
@@ -4,9 +4,20 @@ Service layer để tương tác với Microsoft Graph API
 import msal
 import requests
 import base64
+import contextvars
 import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
 from typing import Dict, List, Optional
-from config import CLIENT_ID, TENANT_ID, CLIENT_SECRET, GRAPH_API_ENDPOINT, AUTHORITY, SCOPE
+from urllib.parse import quote
+from config import (CLIENT_ID, TENANT_ID, CLIENT_SECRET, GRAPH_API_ENDPOINT, AUTHORITY, SCOPE,
+                    ARCHIVE_BATCH_SIZE, GRAPH_CONNECT_TIMEOUT, GRAPH_READ_TIMEOUT, GRAPH_SEND_TIMEOUT,
+                    GRAPH_BREAKER_ERROR_RATE, GRAPH_BREAKER_MIN_REQUESTS, GRAPH_BREAKER_WINDOW_SECONDS,
+                    GRAPH_BREAKER_OPEN_SECONDS, GRAPH_HEDGE_DELAY_MS, GRAPH_HEDGE_MAX_WORKERS)
+from circuit_breaker import CircuitBreaker
+
+logger = logging.getLogger(__name__)
 
 
 class GraphService:
@@ -20,6 +31,173 @@ class GraphService:
         self.scope = SCOPE
         self.access_token = None
         self.token_expiry = 0  # Timestamp khi token hết hạn (5 phút)
+        # MSAL app tạo một lần (authority discovery tốn 1 round-trip)
+        self._msal_app = None
+        # Session dùng chung để reuse connection pool (keep-alive, TLS), tạo trong open()
+        self.session = None
+        # Cache folder id theo tên thư mục archive
+        self._folder_ids = {}
+        # Fail fast khi Graph lỗi nhiều
+        self.breaker = CircuitBreaker(
+            'Graph API',
+            error_rate_threshold=GRAPH_BREAKER_ERROR_RATE,
+            min_requests=GRAPH_BREAKER_MIN_REQUESTS,
+            window_seconds=GRAPH_BREAKER_WINDOW_SECONDS,
+            open_seconds=GRAPH_BREAKER_OPEN_SECONDS
+        )
+        # Thread pool cho hedged request (chỉ tạo khi bật hedging), tạo trong open()
+        self._hedge_executor = None
+        self._hedge_slots = None
+        self.open()
+    
+    def _get_msal_app(self) -> msal.ConfidentialClientApplication:
+        """Tạo MSAL app lần đầu, các lần sau dùng lại"""
+        if self._msal_app is None:
+            self._msal_app = msal.ConfidentialClientApplication(
+                self.client_id,
+                authority=self.authority,
+                client_credential=self.client_secret,
+                timeout=GRAPH_READ_TIMEOUT
+            )
+        return self._msal_app
+    
+    def warm_up(self, user_email: str) -> None:
+        """
+        Chuẩn bị sẵn token và connection tới Graph trước request đầu tiên
+        
+        - Authority discovery + lấy access token
+        - Mở connection (TLS handshake) tới Graph và kiểm tra quyền truy cập mailbox
+        
+        Raises:
+            Exception nếu không lấy được token hoặc Graph không phản hồi đúng
+        """
+        token = self.get_access_token()
+        
+        endpoint = f"{GRAPH_API_ENDPOINT}/users/{user_email}/mailFolders/inbox"
+        headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        params = {'$select': 'id'}
+        
+        response = self._send('GET', endpoint, headers, GRAPH_READ_TIMEOUT, params=params)
+        
+        if response.status_code != 200:
+            raise Exception(f"Warm-up Graph thất bại: {response.status_code} - {response.text[:200]}")
+    
+    def open(self) -> None:
+        """
+        Tạo connection pool và thread pool hedging nếu chưa có
+
+        Gọi khi lifespan khởi động để dùng lại được service sau close()
+        (reload, lifespan chạy nhiều lần); gọi lại khi đang mở thì không làm gì
+        """
+        if self.session is None:
+            self.session = requests.Session()
+        if self._hedge_executor is None and GRAPH_HEDGE_DELAY_MS > 0:
+            self._hedge_executor = ThreadPoolExecutor(
+                max_workers=GRAPH_HEDGE_MAX_WORKERS, thread_name_prefix='graph-hedge'
+            )
+            # Chỉ gửi hedge khi còn worker rảnh, không để hedge xếp hàng trong pool
+            self._hedge_slots = threading.BoundedSemaphore(GRAPH_HEDGE_MAX_WORKERS)
+    
+    def close(self) -> None:
+        """Đóng connection pool và thread pool hedging khi tắt ứng dụng"""
+        if self._hedge_executor:
+            self._hedge_executor.shutdown(wait=False)
+            self._hedge_executor = None
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+    
+    def _send(self, method: str, endpoint: str, headers: Dict, timeout: float,
+              **kwargs) -> requests.Response:
+        """
+        Một HTTP call tới Graph qua circuit breaker, có timeout
+        
+        Lỗi kết nối/timeout, 5xx và 429 được tính là lỗi cho breaker
+        
+        Raises:
+            CircuitOpenError: Nếu breaker đang open
+        """
+        self.breaker.before_call()
+        try:
+            response = self.session.request(
+                method, endpoint, headers=headers,
+                timeout=(GRAPH_CONNECT_TIMEOUT, timeout), **kwargs
+            )
+        except Exception:
+            self.breaker.record(False)
+            raise
+        
+        self.breaker.record(response.status_code < 500 and response.status_code != 429)
+        return response
+    
+    def _hedged_get(self, endpoint: str, headers: Dict, timeout: float,
+                    **kwargs) -> requests.Response:
+        """
+        GET idempotent với hedging để giảm tail latency
+        
+        Nếu request đầu chưa xong sau GRAPH_HEDGE_DELAY_MS thì gửi thêm request thứ hai,
+        dùng kết quả thành công về trước. Tắt hedging thì như _send thông thường.
+        """
+        if not self._hedge_executor:
+            return self._send('GET', endpoint, headers, timeout, **kwargs)
+        
+        # Request đầu chạy trên thread riêng, không qua thread pool hedging: request hedge
+        # bị thua vẫn giữ worker tới read timeout, không được để request đầu xếp hàng sau chúng
+        futures = [self._start_thread(self._send, 'GET', endpoint, headers, timeout, **kwargs)]
+        done, _ = wait(futures, timeout=GRAPH_HEDGE_DELAY_MS / 1000)
+        if not done:
+            if self._hedge_slots.acquire(blocking=False):
+                logger.debug("⏱️ Hedged GET %s", endpoint)
+                hedge = self._hedge_executor.submit(contextvars.copy_context().run,
+                                                    self._send, 'GET', endpoint, headers, timeout, **kwargs)
+                hedge.add_done_callback(lambda _: self._hedge_slots.release())
+                futures.append(hedge)
+            else:
+                # Pool hedging đã đầy (Graph đang chậm) → chỉ chờ request đầu
+                logger.debug("⏱️ Bỏ qua hedge GET %s, thread pool hedging đã đầy", endpoint)
+        
+        # Lấy response thành công về trước, nếu cả hai lỗi thì trả về/raise lỗi cuối
+        pending = set(futures)
+        last_response = None
+        last_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+                if response.status_code < 500 and response.status_code != 429:
+                    return response
+                last_response = response
+        
+        if last_response is not None:
+            return last_response
+        raise last_error
+    
+    @staticmethod
+    def _start_thread(fn, *args, **kwargs) -> Future:
+        """
+        Chạy fn trên thread mới, trả về Future chứa kết quả
+
+        Chạy trong bản copy context của thread gọi để log vẫn có request id
+        """
+        future = Future()
+        context = contextvars.copy_context()
+        
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(context.run(fn, *args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+        
+        threading.Thread(target=run, name='graph-request', daemon=True).start()
+        return future
     
     def get_access_token(self) -> str:
         """
@@ -33,17 +211,13 @@ class GraphService:
         # Kiểm tra xem token còn valid không (trong vòng 5 phút)
         if self.access_token and current_time < self.token_expiry:
             remaining_seconds = int(self.token_expiry - current_time)
-            print(f"🔄 Reuse token (còn {remaining_seconds}s)")
+            logger.debug("🔄 Reuse token (còn %ss)", remaining_seconds)
             return self.access_token
         
         # Token hết hạn hoặc chưa có token → lấy mới
-        print("🔑 Lấy access token mới...")
+        logger.info("🔑 Lấy access token mới...")
         
-        app = msal.ConfidentialClientApplication(
-            self.client_id,
-            authority=self.authority,
-            client_credential=self.client_secret
-        )
+        app = self._get_msal_app()
         
         result = app.acquire_token_for_client(scopes=self.scope)
         
@@ -51,7 +225,7 @@ class GraphService:
             self.access_token = result["access_token"]
             # Set expire sau 5 phút (300 giây)
             self.token_expiry = current_time + 300
-            print(f"✅ Token mới - valid trong 5 phút")
+            logger.info("✅ Token mới - valid trong 5 phút")
             return self.access_token
         else:
             error_msg = result.get('error_description', 'Unknown error')
@@ -71,6 +245,7 @@ class GraphService:
             cc_recipients: Danh sách email CC
             attachments: Danh sách file đính kèm
                         [{"filename": "file.pdf", "content": bytes, "content_type": "application/pdf"}]
+                        hoặc dùng "content_base64" (str) thay cho "content" nếu đã encode sẵn
         """
         token = self.get_access_token()
         
@@ -98,9 +273,10 @@ class GraphService:
         if attachments and len(attachments) > 0:
             attachment_list = []
             for att in attachments:
-                # Encode file content thành base64
-                content_bytes = att["content"]
-                content_base64 = base64.b64encode(content_bytes).decode('utf-8')
+                # Encode file content thành base64 (bỏ qua nếu đã encode sẵn)
+                content_base64 = att.get("content_base64")
+                if content_base64 is None:
+                    content_base64 = base64.b64encode(att["content"]).decode('utf-8')
                 
                 attachment_list.append({
                     "@odata.type": "#microsoft.graph.fileAttachment",
@@ -118,7 +294,8 @@ class GraphService:
             'Content-Type': 'application/json'
         }
         
-        response = requests.post(endpoint, headers=headers, json=message)
+        # Không retry/hedge: sendMail không idempotent
+        response = self._send('POST', endpoint, headers, GRAPH_SEND_TIMEOUT, json=message)
         
         if response.status_code == 202:
             attachment_count = len(attachments) if attachments else 0
@@ -129,17 +306,22 @@ class GraphService:
         else:
             raise Exception(f"Lỗi khi gửi email: {response.status_code} - {response.text}")
     
-    def get_unread_messages(self, user_email: str) -> List[Dict]:
+    def get_unread_messages(self, user_email: str, folder: Optional[str] = None) -> List[Dict]:
         """
         Lấy danh sách email chưa đọc từ hộp thư
         
         Args:
             user_email: Email cần kiểm tra
+            folder: Thư mục cần poll (folder id hoặc well-known name như inbox),
+                    None = tất cả thư mục
         """
         token = self.get_access_token()
         
         # Query để lấy email chưa đọc
-        endpoint = f"{GRAPH_API_ENDPOINT}/users/{user_email}/messages"
+        if folder:
+            endpoint = f"{GRAPH_API_ENDPOINT}/users/{user_email}/mailFolders/{folder}/messages"
+        else:
+            endpoint = f"{GRAPH_API_ENDPOINT}/users/{user_email}/messages"
         params = {
             '$filter': 'isRead eq false',
             '$select': 'id,subject,from,receivedDateTime,bodyPreview,body',
@@ -152,7 +334,7 @@ class GraphService:
             'Content-Type': 'application/json'
         }
         
-        response = requests.get(endpoint, headers=headers, params=params)
+        response = self._hedged_get(endpoint, headers, GRAPH_READ_TIMEOUT, params=params)
         
         if response.status_code == 200:
             data = response.json()
@@ -181,31 +363,200 @@ class GraphService:
         
         data = {"isRead": True}
         
-        response = requests.patch(endpoint, headers=headers, json=data)
+        response = self._send('PATCH', endpoint, headers, GRAPH_READ_TIMEOUT, json=data)
         
         # Graph API trả về 200 OK hoặc 204 No Content khi thành công
         if response.status_code in [200, 204]:
             return True
         else:
             # Log lỗi để debug
-            print(f"⚠️ Mark as read failed: Status {response.status_code}, Response: {response.text[:200]}")
+            logger.warning("⚠️ Mark as read failed: Status %s, Response: %s", response.status_code, response.text[:200])
             return False
     
+    # Well-known folder names Graph chấp nhận trực tiếp làm destinationId
+    WELL_KNOWN_FOLDERS = {'archive', 'deleteditems', 'drafts', 'inbox', 'junkemail', 'sentitems'}
+    
+    def resolve_folder_id(self, user_email: str, folder: str) -> str:
+        """
+        Lấy folder id từ tên thư mục hoặc folder id, tạo thư mục ở root nếu chưa có
+        
+        Args:
+            user_email: Email người dùng
+            folder: Tên thư mục, folder id hoặc well-known name
+        
+        Returns:
+            Folder id (hoặc well-known name) dùng được cho API move
+        """
+        if folder.lower() in self.WELL_KNOWN_FOLDERS:
+            return folder.lower()
+        if folder in self._folder_ids:
+            return self._folder_ids[folder]
+        
+        token = self.get_access_token()
+        headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        
+        endpoint = f"{GRAPH_API_ENDPOINT}/users/{user_email}/mailFolders"
+        folder_id = self._find_folder_id(endpoint, headers, folder)
+        if not folder_id:
+            # Không có thư mục nào tên như vậy → có thể là folder id
+            folder_id = self._get_folder_by_id(endpoint, headers, folder)
+        if not folder_id:
+            # Chưa có → tạo mới
+            response = self._make_request_with_retry('POST', endpoint, headers, json={'displayName': folder})
+            if response.status_code == 201:
+                folder_id = response.json()['id']
+                logger.info("📁 Đã tạo thư mục '%s'", folder)
+            elif response.status_code == 409:
+                # Worker khác vừa tạo cùng thư mục → tìm lại
+                folder_id = self._find_folder_id(endpoint, headers, folder)
+            if not folder_id:
+                raise Exception(f"Lỗi khi tạo thư mục '{folder}': {response.status_code} - {response.text[:200]}")
+        
+        self._folder_ids[folder] = folder_id
+        return folder_id
+    
+    def _find_folder_id(self, endpoint: str, headers: Dict, folder: str) -> Optional[str]:
+        """Tìm thư mục theo displayName, trả về None nếu chưa có"""
+        escaped_name = folder.replace("'", "''")
+        params = {'$filter': f"displayName eq '{escaped_name}'", '$select': 'id'}
+        response = self._make_request_with_retry('GET', endpoint, headers, params=params)
+        
+        if response.status_code != 200:
+            raise Exception(f"Lỗi khi tìm thư mục '{folder}': {response.status_code} - {response.text[:200]}")
+        
+        folders = response.json().get('value', [])
+        return folders[0]['id'] if folders else None
+    
+    def _get_folder_by_id(self, endpoint: str, headers: Dict, folder: str) -> Optional[str]:
+        """Kiểm tra giá trị cấu hình có phải folder id không, trả về None nếu không phải"""
+        response = self._make_request_with_retry(
+            'GET', f"{endpoint}/{quote(folder, safe='')}", headers, params={'$select': 'id'}
+        )
+        
+        if response.status_code == 200:
+            return response.json()['id']
+        # Graph trả 400 (id sai định dạng) hoặc 404 (không có thư mục) nếu không phải id
+        if response.status_code in (400, 404):
+            return None
+        raise Exception(f"Lỗi khi tìm thư mục '{folder}': {response.status_code} - {response.text[:200]}")
+    
+    def move_messages(self, user_email: str, message_ids: List[str], destination_id: str) -> int:
+        """
+        Di chuyển nhiều email sang thư mục khác bằng Graph JSON batching
+        
+        Args:
+            user_email: Email người dùng
+            message_ids: Danh sách ID message cần di chuyển
+            destination_id: Folder id hoặc well-known name của thư mục đích
+        
+        Returns:
+            Số email di chuyển thành công
+        """
+        token = self.get_access_token()
+        
+        endpoint = f"{GRAPH_API_ENDPOINT}/$batch"
+        headers = {
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        }
+        
+        moved_count = 0
+        for start in range(0, len(message_ids), ARCHIVE_BATCH_SIZE):
+            moved_count += self._move_batch(
+                endpoint, headers, user_email, message_ids[start:start + ARCHIVE_BATCH_SIZE], destination_id
+            )
+        
+        return moved_count
+    
+    def _move_batch(self, endpoint: str, headers: Dict, user_email: str, message_ids: List[str],
+                    destination_id: str, max_retries: int = 3) -> int:
+        """
+        Gửi một $batch move, retry các item bị throttle (429) hoặc lỗi 5xx
+        
+        Graph throttle theo từng item trong batch (mỗi mailbox ~4 request đồng thời),
+        nên item lỗi được gửi lại trong batch mới sau Retry-After của item đó
+        (hoặc exponential backoff 1s → 2s → 4s nếu không có Retry-After)
+        
+        Returns:
+            Số email di chuyển thành công
+        """
+        moved_count = 0
+        pending = list(message_ids)
+        
+        for attempt in range(max_retries):
+            batch = {
+                "requests": [
+                    {
+                        "id": str(index),
+                        "method": "POST",
+                        "url": f"/users/{user_email}/messages/{message_id}/move",
+                        "headers": {"Content-Type": "application/json"},
+                        "body": {"destinationId": destination_id}
+                    } for index, message_id in enumerate(pending)
+                ]
+            }
+            
+            response = self._make_request_with_retry('POST', endpoint, headers, json=batch)
+            
+            if response.status_code != 200:
+                logger.warning("⚠️ Move batch failed: Status %s, Response: %s", response.status_code, response.text[:200])
+                return moved_count
+            
+            retry_ids = []
+            wait_time = 2 ** attempt
+            for item in response.json().get('responses', []):
+                status = item.get('status')
+                if status == 201:
+                    moved_count += 1
+                elif status == 429 or (status or 0) >= 500:
+                    retry_ids.append(pending[int(item['id'])])
+                    item_headers = {k.lower(): v for k, v in (item.get('headers') or {}).items()}
+                    try:
+                        wait_time = max(wait_time, int(item_headers.get('retry-after', 0)))
+                    except ValueError:
+                        pass
+                else:
+                    logger.warning("⚠️ Move message failed: Status %s, Response: %s", status, str(item.get('body'))[:200])
+            
+            if not retry_ids:
+                return moved_count
+            
+            if attempt < max_retries - 1:
+                logger.warning("⚠️ %s email bị throttle khi move, retry sau %ss (attempt %s/%s)",
+                               len(retry_ids), wait_time, attempt + 1, max_retries)
+                time.sleep(wait_time)
+            pending = retry_ids
+        
+        logger.warning("⚠️ Không move được %s email sau %s lần thử", len(pending), max_retries)
+        return moved_count
+    
     def _make_request_with_retry(self, method: str, endpoint: str, headers: Dict, 
-                                  max_retries: int = 3, **kwargs) -> requests.Response:
+                                  max_retries: int = 3, timeout: float = GRAPH_READ_TIMEOUT,
+                                  hedge: bool = False, **kwargs) -> requests.Response:
         """
         HTTP request với retry cho rate limit/errors
         
         Retry với exponential backoff: 1s → 2s → 4s
+        Breaker open (CircuitOpenError) thì dừng ngay, không retry
+        
+        Args:
+            timeout: Read timeout cho mỗi lần gọi (giây)
+            hedge: Dùng hedged request (chỉ cho GET idempotent)
         """
         for attempt in range(max_retries):
             try:
-                response = requests.request(method, endpoint, headers=headers, **kwargs)
+                if hedge:
+                    response = self._hedged_get(endpoint, headers, timeout, **kwargs)
+                else:
+                    response = self._send(method, endpoint, headers, timeout, **kwargs)
                 
                 # Nếu gặp 429 (rate limit) hoặc 503 (service unavailable), retry
                 if response.status_code in [429, 503] and attempt < max_retries - 1:
                     wait_time = 2 ** attempt  # 1s, 2s, 4s
-                    print(f"⚠️ Error {response.status_code}, retry sau {wait_time}s (attempt {attempt + 1}/{max_retries})")
+                    logger.warning("⚠️ Error %s, retry sau %ss (attempt %s/%s)", response.status_code, wait_time, attempt + 1, max_retries)
                     time.sleep(wait_time)
                     continue
                 
@@ -214,7 +565,7 @@ class GraphService:
             except requests.exceptions.RequestException as e:
                 if attempt < max_retries - 1:
                     wait_time = 2 ** attempt
-                    print(f"⚠️ Request error: {e}, retry sau {wait_time}s")
+                    logger.warning("⚠️ Request error: %s, retry sau %ss", e, wait_time)
                     time.sleep(wait_time)
                     continue
                 raise
@@ -240,7 +591,7 @@ class GraphService:
             'Content-Type': 'application/json'
         }
         
-        response = self._make_request_with_retry('GET', endpoint, headers)
+        response = self._make_request_with_retry('GET', endpoint, headers, hedge=True)
         
         if response.status_code == 200:
             data = response.json()
@@ -258,6 +609,6 @@ class GraphService:
             
             return attachments
         else:
-            print(f"⚠️ Get attachments failed: Status {response.status_code}, Response: {response.text[:200]}")
+            logger.warning("⚠️ Get attachments failed: Status %s, Response: %s", response.status_code, response.text[:200])
             return []
 
@@ -0,0 +1,124 @@
+"""
+Cấu hình logging cho ứng dụng
+
+- Ghi log bất đồng bộ: logger chỉ đẩy record vào queue, thread riêng ghi ra stdout
+- Log dạng JSON (mỗi dòng một record) kèm request id để trace theo request
+- Sampling cho log theo từng message (LOG_SAMPLE_RATE), WARNING trở lên luôn được ghi
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import zlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from config import LOG_LEVEL, LOG_SAMPLE_RATE
+
+# Request id của request hiện tại (set bởi middleware trong main.py)
+request_id_var: ContextVar[str] = ContextVar('request_id', default='-')
+
+# Các attribute mặc định của LogRecord, không đưa vào field extra của JSON
+_RESERVED_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+_queue_handler = None
+
+
+class ContextFilter(logging.Filter):
+    """Gắn request id và áp dụng sampling, chạy trong thread gọi log"""
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_threshold = int(sample_rate * 10000)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+
+        # Sampling theo sample_key (thường là message id) để các dòng log
+        # của cùng một message được giữ hoặc bỏ cùng nhau
+        sample_key = getattr(record, 'sample_key', None)
+        if sample_key is not None and record.levelno < logging.WARNING:
+            return zlib.crc32(str(sample_key).encode('utf-8')) % 10000 < self.sample_threshold
+
+        return True
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler không format record ở thread gọi log
+
+    QueueHandler.prepare mặc định format message + traceback ngay trong thread gọi
+    (để record pickle được) và xóa exc_info. Queue ở đây nằm trong cùng process nên
+    chỉ cần copy record, việc format (kể cả traceback) dồn sang thread listener.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return copy.copy(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """Format record thành một dòng JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage()
+        }
+
+        # Các field truyền qua extra={...}
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and key not in data:
+                data[key] = value
+
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging() -> None:
+    """
+    Khởi tạo root logger với QueueHandler và start thread ghi log
+
+    Gọi nhiều lần chỉ có tác dụng lần đầu
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter(LOG_SAMPLE_RATE))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    _queue_handler = queue_handler
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    """
+    Gỡ QueueHandler khỏi root logger, ghi nốt các record còn trong queue
+    và dừng thread ghi log
+
+    Sau khi shutdown có thể gọi lại setup_logging (ví dụ lifespan chạy lại)
+    """
+    global _listener, _queue_handler
+    if _queue_handler is not None:
+        logging.getLogger().removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
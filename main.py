@@ -1,23 +1,173 @@
 """
 FastAPI application cho email processor
 """
-from fastapi import FastAPI, HTTPException, Form, File, UploadFile, Header, Security
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Form, File, UploadFile, Header, Security, BackgroundTasks, Request
+from fastapi.responses import JSONResponse
 from fastapi.security import APIKeyHeader
 from pydantic import BaseModel, EmailStr
 from typing import Optional, List, Dict
 from graph_service import GraphService
-from config import USER_EMAIL, API_KEY, generate_email_body, parse_email_body
+from message_lease import MessageLeaseStore
+from attachment_cache import AttachmentCache
+from log_config import setup_logging, shutdown_logging, request_id_var
+from admission import AdmissionLimiter, AdmissionRejected
+from circuit_breaker import CircuitOpenError
+from config import (USER_EMAIL, API_KEY, MAIL_POLL_FOLDER, ARCHIVE_PROCESSED_FOLDER, ARCHIVE_REJECTED_FOLDER,
+                    MAX_ATTACHMENT_BYTES, SEND_MAX_CONCURRENT, SEND_MAX_INFLIGHT_BYTES, SEND_MAX_QUEUE,
+                    RECEIVE_MAX_CONCURRENT, RECEIVE_MAX_QUEUE,
+                    ADMISSION_QUEUE_TIMEOUT_SECONDS, ADMISSION_RETRY_AFTER_SECONDS, READY_RETRY_INTERVAL_SECONDS,
+                    generate_email_body, parse_email_body, warm_up_templates)
+import asyncio
+import logging
+import threading
+import time
 import re
 import json
+import uuid
+
+# Khởi tạo logging trước khi tạo các service
+setup_logging()
+logger = logging.getLogger(__name__)
+
+# Khởi tạo Graph Service
+graph_service = GraphService()
+
+# Admission control theo endpoint: giới hạn concurrency và bytes đang xử lý
+admission_limiters = {
+    "/sendDocumentOutgoing": AdmissionLimiter(
+        "sendDocumentOutgoing",
+        max_concurrent=SEND_MAX_CONCURRENT,
+        max_inflight_bytes=SEND_MAX_INFLIGHT_BYTES,
+        max_queue=SEND_MAX_QUEUE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS,
+        retry_after=ADMISSION_RETRY_AFTER_SECONDS,
+        # Upload chunked (không có Content-Length) tính theo kích thước tối đa
+        default_request_bytes=MAX_ATTACHMENT_BYTES
+    ),
+    "/receiveDocumentIncoming": AdmissionLimiter(
+        "receiveDocumentIncoming",
+        max_concurrent=RECEIVE_MAX_CONCURRENT,
+        max_queue=RECEIVE_MAX_QUEUE,
+        queue_timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS,
+        retry_after=ADMISSION_RETRY_AFTER_SECONDS
+    )
+}
+
+# Trạng thái readiness (khác liveness): chỉ ready khi warm-up thành công
+readiness_state = {"ready": False, "last_attempt": 0.0}
+# Chỉ một warm-up chạy tại một thời điểm
+_warm_up_lock = threading.Lock()
+
+
+def warm_up(force: bool = False) -> bool:
+    """
+    Warm-up các resource trước khi nhận traffic
+    
+    - Kiểm tra template/parser
+    - Lấy access token và mở connection pool tới Graph
+    
+    Args:
+        force: Bỏ qua khoảng cách tối thiểu READY_RETRY_INTERVAL_SECONDS giữa các lần thử
+    
+    Returns:
+        True nếu warm-up thành công
+    """
+    # Đang có warm-up khác chạy → dùng trạng thái hiện tại, không gọi MSAL/Graph thêm
+    if not _warm_up_lock.acquire(blocking=False):
+        return readiness_state["ready"]
+    
+    try:
+        if readiness_state["ready"]:
+            return True
+        if not force and time.monotonic() - readiness_state["last_attempt"] < READY_RETRY_INTERVAL_SECONDS:
+            return False
+        
+        readiness_state["last_attempt"] = time.monotonic()
+        if not warm_up_templates():
+            raise Exception("Email template không parse lại được, kiểm tra email_format.txt")
+        graph_service.warm_up(USER_EMAIL)
+        readiness_state["ready"] = True
+        logger.info("✅ Warm-up hoàn tất - service sẵn sàng")
+    except Exception as e:
+        # Chi tiết lỗi (MSAL error_description, response Graph) chỉ ghi log, không trả về client
+        logger.warning("⚠️ Warm-up thất bại: %s", e)
+    finally:
+        _warm_up_lock.release()
+    return readiness_state["ready"]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm-up khi khởi động, giải phóng connection pool và flush log khi tắt"""
+    # Khởi tạo lại logging và connection pool nếu lifespan trước đã shutdown (no-op nếu đang chạy)
+    setup_logging()
+    graph_service.open()
+    await asyncio.to_thread(warm_up, True)
+    yield
+    graph_service.close()
+    # Lifespan sau phải warm-up lại với connection pool mới
+    readiness_state["ready"] = False
+    shutdown_logging()
+
 
 app = FastAPI(
     title="Email Processor API",
     description="API để gửi và nhận email thông qua Microsoft Graph API",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
-# Khởi tạo Graph Service
-graph_service = GraphService()
+# Lease message dùng chung giữa các worker để không xử lý trùng
+lease_store = MessageLeaseStore()
+
+# Cache file đính kèm đã encode base64 theo SHA-256
+attachment_cache = AttachmentCache()
+
+@app.middleware("http")
+async def admission_middleware(request: Request, call_next):
+    """
+    Admission control cho endpoint nặng, chạy trước khi đọc body
+    
+    Request vượt giới hạn bị từ chối với 503 + Retry-After
+    """
+    limiter = admission_limiters.get(request.url.path)
+    if limiter is None:
+        return await call_next(request)
+    
+    # Ước lượng bytes request giữ trong bộ nhớ từ Content-Length,
+    # thiếu hoặc sai header thì tính theo default_request_bytes của endpoint
+    try:
+        nbytes = int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        nbytes = limiter.default_request_bytes
+    
+    try:
+        async with limiter.acquire(nbytes) as slot:
+            # Handler dùng slot để tính thêm bytes biết được trong lúc xử lý
+            request.state.admission_slot = slot
+            return await call_next(request)
+    except AdmissionRejected as e:
+        logger.warning("⛔ %s", e, extra={"endpoint": limiter.name, **limiter.metrics()})
+        return JSONResponse(
+            status_code=503,
+            content={"detail": str(e)},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+
+@app.middleware("http")
+async def request_id_middleware(request: Request, call_next):
+    """Gắn request id (từ header X-Request-ID hoặc tự sinh) vào log và response"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id_var.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 
 # API Key Security
 api_key_header = APIKeyHeader(name="X-API-Key", auto_error=True)
@@ -126,7 +276,7 @@ def validate_email_body_format(body_content: str) -> tuple[bool, Optional[str]]:
 
 @app.get("/")
 async def root():
-    """Health check endpoint"""
+    """Health check endpoint (liveness)"""
     return {
         "status": "running",
         "message": "Email Processor API đang hoạt động",
@@ -134,11 +284,60 @@ async def root():
     }
 
 
+@app.get("/ready")
+async def ready():
+    """
+    Readiness endpoint
+    
+    Trả về 200 khi đã có token và connection tới Graph, 503 nếu chưa.
+    Nếu warm-up lúc khởi động thất bại, thử lại tối đa một lần mỗi READY_RETRY_INTERVAL_SECONDS.
+    """
+    if not readiness_state["ready"]:
+        await asyncio.to_thread(warm_up)
+    
+    if readiness_state["ready"]:
+        return {"status": "ready"}
+    
+    return JSONResponse(
+        status_code=503,
+        content={"status": "not_ready"}
+    )
+
+
+def archive_messages(message_ids: List[str], folder: str) -> None:
+    """
+    Di chuyển email đã xử lý sang thư mục archive (chạy background sau khi trả response)
+    
+    Args:
+        message_ids: Danh sách ID message cần archive
+        folder: Tên/ID thư mục archive
+    """
+    try:
+        destination_id = graph_service.resolve_folder_id(USER_EMAIL, folder)
+        moved_count = graph_service.move_messages(USER_EMAIL, message_ids, destination_id)
+        logger.info("📦 Đã archive %s/%s email vào '%s'", moved_count, len(message_ids), folder)
+    except Exception as e:
+        logger.warning("⚠️ Lỗi khi archive email vào '%s': %s", folder, e)
+
+
+@app.get("/metrics/admission")
+async def admission_metrics(api_key: str = Security(verify_api_key)):
+    """Metrics admission control của worker hiện tại (in-flight, hàng đợi, thời gian chờ)"""
+    return {limiter.name: limiter.metrics() for limiter in admission_limiters.values()}
+
+
+@app.get("/metrics/graph")
+async def graph_metrics(api_key: str = Security(verify_api_key)):
+    """Trạng thái circuit breaker Graph API của worker hiện tại"""
+    return {"circuitBreaker": graph_service.breaker.metrics()}
+
+
 @app.post("/sendDocumentOutgoing", 
           summary="Gửi email công văn đi",
           description="API để gửi email với file đính kèm thông qua Microsoft Graph API")
 async def send_document_outgoing(
-    data: str = Form(..., description="JSON string chứa thông tin email: {mailTo, subject, information, cc}"),
+    request: Request,
+    data: str = Form(..., description="JSON string chứa thông tin email: {mailTo, subject, information, cc, attachmentRefs}"),
     files: List[UploadFile] = File(None, description="Danh sách file đính kèm (optional)"),
     api_key: str = Security(verify_api_key)
 ):
@@ -146,9 +345,13 @@ async def send_document_outgoing(
     Gửi email công văn đi với file đính kèm
     
     Args:
-        data: JSON string chứa thông tin email (mailTo, subject, information, cc)
+        data: JSON string chứa thông tin email (mailTo, subject, information, cc, attachmentRefs)
         files: Danh sách file đính kèm (optional)
     
+    attachmentRefs (optional): Tham chiếu file đã upload ở request trước theo SHA-256
+    (trả về trong response), không cần upload lại. Nếu file không còn trong cache
+    API trả về 404 và client cần upload lại file.
+    
     Returns:
         Thông tin kết quả gửi email
         
@@ -167,7 +370,10 @@ async def send_document_outgoing(
                 "docId": "CV-123",
                 "returnEmail": "reply@example.com"
             },
-            "cc": "manager@example.com"
+            "cc": "manager@example.com",
+            "attachmentRefs": [
+                {"sha256": "9f86d0...", "filename": "quy-dinh.pdf", "contentType": "application/pdf"}
+            ]
         }
     """
     try:
@@ -214,7 +420,7 @@ async def send_document_outgoing(
         # Xử lý files đính kèm
         attachments = []
         total_size = 0
-        max_size = 25 * 1024 * 1024  # 25MB limit cho Graph API
+        max_size = MAX_ATTACHMENT_BYTES  # 25MB limit cho Graph API
         
         if files:
             for file in files:
@@ -230,17 +436,58 @@ async def send_document_outgoing(
                         detail=f"Tổng kích thước file vượt quá giới hạn 25MB (hiện tại: {total_size / 1024 / 1024:.2f}MB)"
                     )
                 
-                attachments.append({
-                    "filename": file.filename,
-                    "content": file_content,
-                    "content_type": file.content_type or "application/octet-stream"
-                })
+                # Encode base64 qua cache (file trùng nội dung không phải encode lại)
+                # Chạy trong thread: SHA-256 + base64 file tới 25MB không được block event loop
+                attachments.append(await asyncio.to_thread(
+                    attachment_cache.add,
+                    file_content,
+                    file.filename,
+                    file.content_type or "application/octet-stream"
+                ))
                 
                 # Reset file pointer để có thể đọc lại nếu cần
                 await file.seek(0)
         
+        # Xử lý file tham chiếu theo SHA-256 (đã upload ở request trước)
+        attachment_refs = email_data.get('attachmentRefs') or []
+        if not isinstance(attachment_refs, list):
+            raise HTTPException(status_code=400, detail="Field 'attachmentRefs' phải là array")
+        
+        for ref in attachment_refs:
+            if not isinstance(ref, dict) or not isinstance(ref.get('sha256'), str):
+                raise HTTPException(status_code=400, detail="Mỗi phần tử 'attachmentRefs' phải có field 'sha256'")
+            
+            # File lấy từ cache không nằm trong Content-Length của request → tính thêm
+            # vào in-flight bytes của admission control trước khi đọc vào bộ nhớ
+            cached_size = await asyncio.to_thread(attachment_cache.content_size, ref['sha256'])
+            if cached_size:
+                await request.state.admission_slot.reserve(cached_size)
+            
+            cached = await asyncio.to_thread(attachment_cache.get, ref['sha256'])
+            if not cached:
+                raise HTTPException(
+                    status_code=404,
+                    detail=f"File {ref['sha256']} không có trong cache, vui lòng upload lại file"
+                )
+            
+            total_size += cached["size"]
+            if total_size > max_size:
+                raise HTTPException(
+                    status_code=400, 
+                    detail=f"Tổng kích thước file vượt quá giới hạn 25MB (hiện tại: {total_size / 1024 / 1024:.2f}MB)"
+                )
+            
+            # Cho phép đổi tên file / content type so với lần upload trước
+            attachments.append({
+                **cached,
+                "filename": ref.get('filename') or cached["filename"],
+                "content_type": ref.get('contentType') or cached["content_type"]
+            })
+        
         # Gửi email với attachments
-        result = graph_service.send_email(
+        # Chạy trong thread để không block event loop (admission control vẫn nhận/từ chối request khác)
+        result = await asyncio.to_thread(
+            graph_service.send_email,
             user_email=USER_EMAIL,
             to_recipients=to_emails,
             subject=email_data['subject'],
@@ -265,8 +512,9 @@ async def send_document_outgoing(
             response_data["attachments"] = [
                 {
                     "filename": att["filename"],
-                    "size": len(att["content"]),
-                    "content_type": att["content_type"]
+                    "size": att["size"],
+                    "content_type": att["content_type"],
+                    "sha256": att["sha256"]
                 } for att in attachments
             ]
             response_data["total_attachment_size"] = f"{total_size / 1024:.2f} KB"
@@ -279,6 +527,8 @@ async def send_document_outgoing(
         
     except HTTPException:
         raise
+    except (CircuitOpenError, AdmissionRejected) as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi khi gửi email: {str(e)}")
 
@@ -287,7 +537,8 @@ async def send_document_outgoing(
          response_model=IncomingDocumentsResponse,
          summary="Nhận email công văn đến",
          description="API để kiểm tra và lấy danh sách email chưa đọc có format hợp lệ kèm attachments")
-async def receive_document_incoming(api_key: str = Security(verify_api_key)):
+def receive_document_incoming(background_tasks: BackgroundTasks,
+                              api_key: str = Security(verify_api_key)):
     """
     Nhận email công văn đến
     
@@ -300,20 +551,23 @@ async def receive_document_incoming(api_key: str = Security(verify_api_key)):
     
     Sau khi parse thành công, email sẽ được đánh dấu là đã đọc
     
+    Nếu có cấu hình ARCHIVE_PROCESSED_FOLDER / ARCHIVE_REJECTED_FOLDER, email đã xử lý
+    (và email không đúng format) được chuyển sang thư mục archive ở background
+    
     Returns:
         Danh sách document đã parse với thông tin đầy đủ và attachments
     """
     try:
         # Lấy danh sách email chưa đọc
-        unread_messages = graph_service.get_unread_messages(USER_EMAIL)
+        unread_messages = graph_service.get_unread_messages(USER_EMAIL, MAIL_POLL_FOLDER or None)
         
         # Parse và filter email có format hợp lệ
         parsed_documents = []
         marked_as_read_count = 0
         
+        candidates = []
+        rejected_ids = []
         for message in unread_messages:
-            message_id = message.get('id', '')
-            
             # Lấy body content
             body_content = ""
             if message.get('body'):
@@ -324,6 +578,43 @@ async def receive_document_incoming(api_key: str = Security(verify_api_key)):
             
             # Chỉ xử lý email có format hợp lệ
             if parsed_info:
+                candidates.append((message, parsed_info))
+            elif message.get('id'):
+                rejected_ids.append(message['id'])
+        
+        # Claim các email hợp lệ - email đang được request khác xử lý sẽ bị bỏ qua
+        lease_owner = lease_store.new_owner()
+        claimed_ids = set(lease_store.claim_many(
+            [message.get('id', '') for message, _ in candidates], lease_owner
+        ))
+        skipped_count = len(candidates) - len(claimed_ids)
+        if skipped_count:
+            logger.info("⏭️ Bỏ qua %s email đang được request khác xử lý", skipped_count)
+        
+        archive_ids = []
+        # Lease đang giữ nhưng chưa đánh dấu đã đọc, được trả lại khi kết thúc
+        # (kể cả khi lỗi) để lần poll sau xử lý lại ngay thay vì chờ hết TTL
+        held_ids = set(claimed_ids)
+        
+        try:
+            # Bước 1: lấy attachments và tạo document cho các email đã claim.
+            # Chưa có thay đổi nào trên mailbox nên nếu circuit breaker mở thì
+            # trả 503 để client retry sau (toàn bộ lease được trả lại ở finally)
+            pending = []
+            for message, parsed_info in candidates:
+                message_id = message.get('id', '')
+                if message_id not in claimed_ids:
+                    continue
+                
+                # Gia hạn lease trước mỗi message - scan dài có thể vượt LEASE_TTL_SECONDS
+                if not lease_store.renew(message_id, lease_owner):
+                    logger.info("⏭️ Lease email %s... đã hết hạn và bị request khác claim", message_id[:30])
+                    held_ids.discard(message_id)
+                    continue
+                
+                # Log theo từng message được sampling theo message id (LOG_SAMPLE_RATE)
+                log_extra = {"sample_key": message_id}
+                
                 # Lấy thông tin người gửi
                 from_email = ""
                 if message.get('from') and message['from'].get('emailAddress'):
@@ -333,7 +624,7 @@ async def receive_document_incoming(api_key: str = Security(verify_api_key)):
                 attachments = []
                 try:
                     if message_id:
-                        print(f"📎 Đang lấy attachments cho email {message_id[:30]}...")
+                        logger.debug("📎 Đang lấy attachments cho email %s...", message_id[:30], extra=log_extra)
                         message_attachments = graph_service.get_message_attachments(USER_EMAIL, message_id)
                         
                         for att in message_attachments:
@@ -345,9 +636,12 @@ async def receive_document_incoming(api_key: str = Security(verify_api_key)):
                             ))
                         
                         if attachments:
-                            print(f"✅ Tìm thấy {len(attachments)} attachment(s): {[att.name for att in attachments]}")
+                            logger.info("✅ Tìm thấy %s attachment(s): %s", len(attachments), [att.name for att in attachments],
+                                        extra=log_extra)
+                except CircuitOpenError:
+                    raise
                 except Exception as att_error:
-                    print(f"⚠️ Lỗi khi lấy attachments cho email {message_id[:30]}...: {att_error}")
+                    logger.warning("⚠️ Lỗi khi lấy attachments cho email %s...: %s", message_id[:30], att_error, extra=log_extra)
                     # Tiếp tục xử lý email dù không lấy được attachments
                 
                 # Tạo document info
@@ -368,31 +662,72 @@ async def receive_document_incoming(api_key: str = Security(verify_api_key)):
                     attachments=attachments
                 )
                 
-                parsed_documents.append(document)
+                pending.append(document)
+            
+            # Bước 2: đánh dấu đã đọc. Nếu circuit breaker mở giữa chừng thì dừng
+            # (lần poll sau xử lý lại các email chưa đánh dấu) và chỉ trả về
+            # các email đã đánh dấu; chưa đánh dấu được email nào thì trả 503
+            for index, document in enumerate(pending):
+                message_id = document.messageId
+                log_extra = {"sample_key": message_id}
+                
+                if not lease_store.renew(message_id, lease_owner):
+                    logger.info("⏭️ Lease email %s... đã hết hạn và bị request khác claim", message_id[:30])
+                    held_ids.discard(message_id)
+                    continue
                 
                 # Đánh dấu email đã đọc sau khi parse thành công
+                mark_success = False
                 try:
                     if message_id:
-                        print(f"🔄 Đang đánh dấu email {message_id[:30]}... đã đọc")
+                        logger.debug("🔄 Đang đánh dấu email %s... đã đọc", message_id[:30], extra=log_extra)
                         mark_success = graph_service.mark_as_read(USER_EMAIL, message_id)
                         if mark_success:
                             marked_as_read_count += 1
-                            print(f"✅ Đã đánh dấu email {message_id[:30]}... đã đọc")
+                            logger.info("✅ Đã đánh dấu email %s... đã đọc", message_id[:30], extra=log_extra)
                         else:
-                            print(f"❌ Không thể đánh dấu email {message_id[:30]}... (API trả về False)")
+                            logger.error("❌ Không thể đánh dấu email %s... (API trả về False)", message_id[:30], extra=log_extra)
+                except CircuitOpenError:
+                    if not archive_ids:
+                        raise
+                    logger.warning("⚠️ Circuit breaker mở, %s email chưa đánh dấu sẽ được xử lý ở lần poll sau",
+                                   len(pending) - index)
+                    break
                 except Exception as mark_error:
                     # Log error chi tiết
-                    print(f"❌ Lỗi khi đánh dấu email {message_id[:30]}... đã đọc: {type(mark_error).__name__}: {mark_error}")
-                    import traceback
-                    traceback.print_exc()
+                    logger.exception("❌ Lỗi khi đánh dấu email %s... đã đọc: %s: %s",
+                                     message_id[:30], type(mark_error).__name__, mark_error, extra=log_extra)
+                
+                parsed_documents.append(document)
+                
+                # Đã đánh dấu → giữ lease cho đến khi archive xong hoặc hết TTL,
+                # chưa đánh dấu được → lease được trả lại ở finally
+                if mark_success:
+                    held_ids.discard(message_id)
+                    archive_ids.append(message_id)
+        finally:
+            for held_id in held_ids:
+                lease_store.release(held_id, lease_owner)
+        
+        logger.info("✅ Đã parse %s email và đánh dấu %s email đã đọc", len(parsed_documents), marked_as_read_count)
+        
+        # Archive ở background để không làm chậm response
+        if ARCHIVE_PROCESSED_FOLDER and archive_ids:
+            background_tasks.add_task(archive_messages, archive_ids, ARCHIVE_PROCESSED_FOLDER)
         
-        print(f"✅ Đã parse {len(parsed_documents)} email và đánh dấu {marked_as_read_count} email đã đọc")
+        if ARCHIVE_REJECTED_FOLDER and rejected_ids:
+            # Claim trước để email không đúng format chỉ bị move bởi một request
+            rejected_ids = lease_store.claim_many(rejected_ids, lease_owner)
+            if rejected_ids:
+                background_tasks.add_task(archive_messages, rejected_ids, ARCHIVE_REJECTED_FOLDER)
         
         return IncomingDocumentsResponse(
             length=len(parsed_documents),
             data=parsed_documents
         )
         
+    except CircuitOpenError as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi khi lấy email: {str(e)}")
 
@@ -0,0 +1,133 @@
+"""
+Cơ chế lease (claim) message dùng chung giữa các worker/process
+
+Mỗi message chỉ được một request đang chạy claim tại một thời điểm.
+Lease được lưu trong SQLite (dùng chung giữa các worker uvicorn và các container
+trên cùng host qua volume local) và tự hết hạn sau LEASE_TTL_SECONDS,
+nên request bị crash giữa chừng không giữ message mãi mãi.
+
+DB dùng WAL mode, vốn cần shared memory giữa các process nên không hoạt động
+trên network filesystem (NFS, SMB, EFS...): không đặt LEASE_DB_PATH trên volume
+mạng dùng chung giữa các host, vì khi đó không còn đảm bảo mỗi message chỉ một
+request claim.
+"""
+import sqlite3
+import time
+import uuid
+from typing import Iterable, List
+from config import LEASE_DB_PATH, LEASE_TTL_SECONDS
+
+
+class MessageLeaseStore:
+    """Lưu và kiểm tra lease của message trong SQLite"""
+
+    def __init__(self, db_path: str = LEASE_DB_PATH, ttl_seconds: int = LEASE_TTL_SECONDS):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self._init_db()
+
+    def _connect(self) -> sqlite3.Connection:
+        """
+        Mở connection mới cho mỗi thao tác
+
+        isolation_level=None để tự quản lý transaction bằng BEGIN IMMEDIATE,
+        timeout cho phép chờ khi process khác đang giữ write lock
+        """
+        conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+        conn.execute('PRAGMA busy_timeout = 10000')
+        return conn
+
+    def _init_db(self):
+        """Tạo bảng lease nếu chưa có"""
+        conn = self._connect()
+        try:
+            conn.execute('PRAGMA journal_mode = WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS message_leases ('
+                ' message_id TEXT PRIMARY KEY,'
+                ' owner TEXT NOT NULL,'
+                ' expires_at REAL NOT NULL)'
+            )
+        finally:
+            conn.close()
+
+    @staticmethod
+    def new_owner() -> str:
+        """Tạo owner id duy nhất cho một request"""
+        return uuid.uuid4().hex
+
+    def claim_many(self, message_ids: Iterable[str], owner: str) -> List[str]:
+        """
+        Claim nhiều message trong một transaction
+
+        Args:
+            message_ids: Danh sách ID message cần claim
+            owner: Owner id của request hiện tại
+
+        Returns:
+            Danh sách ID message claim thành công (giữ nguyên thứ tự đầu vào)
+        """
+        ids = [message_id for message_id in message_ids if message_id]
+        if not ids:
+            return []
+
+        now = time.time()
+        expires_at = now + self.ttl_seconds
+        claimed = []
+
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE lấy write lock ngay → các process khác phải chờ
+            conn.execute('BEGIN IMMEDIATE')
+            # Dọn lease đã hết hạn để message có thể được claim lại
+            conn.execute('DELETE FROM message_leases WHERE expires_at <= ?', (now,))
+            for message_id in ids:
+                cursor = conn.execute(
+                    'INSERT OR IGNORE INTO message_leases (message_id, owner, expires_at) VALUES (?, ?, ?)',
+                    (message_id, owner, expires_at)
+                )
+                if cursor.rowcount == 1:
+                    claimed.append(message_id)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+        return claimed
+
+    def renew(self, message_id: str, owner: str) -> bool:
+        """
+        Gia hạn lease thêm ttl_seconds tính từ bây giờ
+
+        Gọi trước khi xử lý từng message để lease không hết hạn giữa chừng
+        khi một lần scan kéo dài hơn TTL
+
+        Returns:
+            True nếu lease vẫn thuộc owner hiện tại, False nếu đã bị request khác claim
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute(
+                'UPDATE message_leases SET expires_at = ? WHERE message_id = ? AND owner = ?',
+                (time.time() + self.ttl_seconds, message_id, owner)
+            )
+            return cursor.rowcount == 1
+        finally:
+            conn.close()
+
+    def release(self, message_id: str, owner: str) -> None:
+        """
+        Trả lại lease để request khác có thể xử lý message ngay
+
+        Chỉ xóa lease nếu vẫn thuộc về owner hiện tại
+        """
+        conn = self._connect()
+        try:
+            conn.execute(
+                'DELETE FROM message_leases WHERE message_id = ? AND owner = ?',
+                (message_id, owner)
+            )
+        finally:
+            conn.close()
@@ -0,0 +1,78 @@
+"""
+Fixture dùng chung cho test: fake Graph server chạy trong thread và GraphService trỏ tới server đó
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+# Cấu hình phải có trước khi import các module của ứng dụng
+_TMP_DIR = tempfile.mkdtemp(prefix='email-api-test-')
+os.environ.setdefault('LEASE_DB_PATH', os.path.join(_TMP_DIR, 'leases.db'))
+os.environ.setdefault('API_KEY', 'test-api-key')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fake_graph_server  # noqa: E402
+import graph_service  # noqa: E402
+from circuit_breaker import CircuitBreaker  # noqa: E402
+
+
+class _QuietGraphServer(ThreadingHTTPServer):
+    """Bỏ qua lỗi khi client đã ngắt kết nối (request bị timeout hoặc thua request hedge)"""
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+@pytest.fixture(scope='session')
+def fake_graph_url():
+    """Start fake Graph server ở port ngẫu nhiên cho cả test session"""
+    fake_graph_server.FakeGraphHandler.log_message = lambda *args: None
+    server = _QuietGraphServer(('127.0.0.1', 0), fake_graph_server.FakeGraphHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1.0"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fake_graph(fake_graph_url, monkeypatch):
+    """Reset dữ liệu và fault injection của fake server, trỏ GraphService tới server"""
+    for name in ('FAULT_ERROR_RATE', 'FAULT_LATENCY_MS', 'FAULT_SLOW_RATE', 'FAULT_SLOW_FIRST'):
+        monkeypatch.setattr(fake_graph_server, name, 0)
+    monkeypatch.setattr(fake_graph_server, 'FAULT_SLOW_MS', 2000)
+    monkeypatch.setattr(fake_graph_server, '_request_count', 0)
+    fake_graph_server._messages.clear()
+    fake_graph_server._folders.clear()
+    fake_graph_server._seed_messages()
+
+    monkeypatch.setattr(graph_service, 'GRAPH_API_ENDPOINT', fake_graph_url)
+    monkeypatch.setattr(graph_service, 'GRAPH_HEDGE_DELAY_MS', 0)
+    return fake_graph_server
+
+
+@pytest.fixture
+def make_service(fake_graph):
+    """Tạo GraphService với token đặt sẵn (bỏ qua MSAL) và breaker ngưỡng nhỏ"""
+    services = []
+
+    def make(hedge_delay_ms: int = 0, open_seconds: float = 0.3) -> graph_service.GraphService:
+        graph_service.GRAPH_HEDGE_DELAY_MS = hedge_delay_ms
+        service = graph_service.GraphService()
+        service.access_token, service.token_expiry = 'fake-token', time.time() + 3600
+        service.breaker = CircuitBreaker(
+            'Graph API', error_rate_threshold=0.5, min_requests=4,
+            window_seconds=30, open_seconds=open_seconds
+        )
+        services.append(service)
+        return service
+
+    yield make
+    for service in services:
+        service.close()
@@ -0,0 +1,169 @@
+"""
+Admission control: hàng đợi, timeout, giới hạn in-flight bytes
+"""
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import admission
+import main
+from admission import AdmissionLimiter, AdmissionRejected
+from attachment_cache import AttachmentCache
+
+
+def _limiter(**kwargs) -> AdmissionLimiter:
+    options = {"max_concurrent": 1, "max_queue": 0, "queue_timeout": 0.2, "retry_after": 3}
+    options.update(kwargs)
+    return AdmissionLimiter('test', **options)
+
+
+def test_rejects_when_queue_full():
+    async def scenario():
+        limiter = _limiter(max_queue=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.acquire():
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+
+        # Một request đang chạy, một request đang chờ → request thứ ba bị từ chối ngay
+        with pytest.raises(AdmissionRejected) as error:
+            async with limiter.acquire():
+                pass
+        assert error.value.retry_after == 3
+        assert limiter.metrics()["waiting"] == 1
+
+        release.set()
+        await asyncio.gather(holder, waiter)
+        return limiter.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert metrics["admitted"] == 2
+    assert metrics["rejected"] == 1
+    assert metrics["inFlight"] == 0 and metrics["waiting"] == 0
+
+
+def test_rejects_after_queue_timeout():
+    async def scenario():
+        limiter = _limiter(max_queue=1, queue_timeout=0.1)
+        async with limiter.acquire():
+            with pytest.raises(AdmissionRejected):
+                async with limiter.acquire():
+                    pass
+        return limiter.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert metrics["rejected"] == 1
+    assert metrics["waiting"] == 0
+
+
+def test_waiting_request_admitted_when_slot_frees():
+    async def scenario():
+        limiter = _limiter(max_queue=1, queue_timeout=1)
+
+        async def hold():
+            async with limiter.acquire():
+                await asyncio.sleep(0.05)
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        async with limiter.acquire():
+            pass
+        await holder
+        return limiter.metrics()
+
+    metrics = asyncio.run(scenario())
+    assert metrics["admitted"] == 2
+    assert metrics["maxQueueTimeMs"] > 0
+
+
+def test_inflight_bytes_limit():
+    async def scenario():
+        limiter = _limiter(max_concurrent=4, max_inflight_bytes=100, max_queue=1, queue_timeout=0.1)
+        async with limiter.acquire(60):
+            assert limiter.metrics()["inFlightBytes"] == 60
+            # Còn slot nhưng không đủ bytes
+            with pytest.raises(AdmissionRejected):
+                async with limiter.acquire(50):
+                    pass
+            async with limiter.acquire(40):
+                assert limiter.metrics()["inFlightBytes"] == 100
+        return limiter.metrics()
+
+    assert asyncio.run(scenario())["inFlightBytes"] == 0
+
+
+def test_oversized_request_allowed_when_idle():
+    async def scenario():
+        limiter = _limiter(max_concurrent=4, max_inflight_bytes=100)
+        async with limiter.acquire(500):
+            assert limiter.metrics()["inFlightBytes"] == 500
+        return limiter.metrics()
+
+    assert asyncio.run(scenario())["rejected"] == 0
+
+
+def test_reserve_charges_extra_bytes_until_release():
+    async def scenario():
+        limiter = _limiter(max_concurrent=4, max_inflight_bytes=100, max_queue=1, queue_timeout=0.1)
+        async with limiter.acquire(10):
+            async with limiter.acquire(10) as slot:
+                await slot.reserve(50)
+                assert limiter.metrics()["inFlightBytes"] == 70
+                # Vượt giới hạn khi còn request khác đang chạy → từ chối
+                with pytest.raises(AdmissionRejected):
+                    await slot.reserve(50)
+                assert slot.nbytes == 60
+            assert limiter.metrics()["inFlightBytes"] == 10
+        return limiter.metrics()
+
+    assert asyncio.run(scenario())["inFlightBytes"] == 0
+
+
+def test_reserve_allowed_when_only_request():
+    async def scenario():
+        limiter = _limiter(max_concurrent=4, max_inflight_bytes=100)
+        async with limiter.acquire(10) as slot:
+            await slot.reserve(500)
+            assert limiter.metrics()["inFlightBytes"] == 510
+        return limiter.metrics()
+
+    assert asyncio.run(scenario())["inFlightBytes"] == 0
+
+
+def test_send_charges_cached_attachment_bytes(make_service, monkeypatch, tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=1024 * 1024)
+    entry = cache.add(b'x' * 3000, 'a.pdf', 'application/pdf')
+    monkeypatch.setattr(main, 'attachment_cache', cache)
+    monkeypatch.setattr(main, 'graph_service', make_service())
+    monkeypatch.setattr(main, 'USER_EMAIL', 'user@example.com')
+
+    reserved = []
+    reserve = admission.AdmissionSlot.reserve
+
+    async def recording_reserve(slot, nbytes):
+        reserved.append(nbytes)
+        await reserve(slot, nbytes)
+
+    monkeypatch.setattr(admission.AdmissionSlot, 'reserve', recording_reserve)
+
+    data = {
+        "mailTo": "to@example.com",
+        "subject": "Công văn",
+        "information": {"docNumber": "1/CV"},
+        "attachmentRefs": [{"sha256": entry["sha256"]}]
+    }
+    response = TestClient(main.app).post(
+        '/sendDocumentOutgoing', data={"data": json.dumps(data)}, headers={"X-API-Key": "test-api-key"}
+    )
+
+    assert response.status_code == 200, response.text
+    # Nội dung base64 của file tham chiếu được tính vào in-flight bytes
+    assert reserved == [len(entry["content_base64"])]
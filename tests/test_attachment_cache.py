@@ -0,0 +1,64 @@
+"""
+Cache file đính kèm trên đĩa: dùng chung giữa các instance và loại bỏ theo LRU
+"""
+import base64
+import hashlib
+import os
+
+from attachment_cache import AttachmentCache
+
+
+def _set_mtime(cache, sha256, mtime):
+    os.utime(cache._path(sha256, '.b64'), (mtime, mtime))
+
+
+def test_add_and_get(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=1024)
+
+    entry = cache.add(b'hello world', 'a.txt', 'text/plain')
+
+    assert entry["sha256"] == hashlib.sha256(b'hello world').hexdigest()
+    assert entry["content_base64"] == base64.b64encode(b'hello world').decode('utf-8')
+    assert cache.get(entry["sha256"].upper())["filename"] == 'a.txt'
+    assert cache.get('not-a-sha256') is None
+    assert cache.get('0' * 64) is None
+
+
+def test_shared_between_instances(tmp_path):
+    # Hai worker dùng chung thư mục cache
+    first = AttachmentCache(str(tmp_path), max_bytes=1024)
+    second = AttachmentCache(str(tmp_path), max_bytes=1024)
+
+    entry = first.add(b'shared', 'shared.pdf', 'application/pdf')
+
+    assert second.get(entry["sha256"])["content_base64"] == entry["content_base64"]
+    # Thêm lại cùng nội dung với tên khác → hit, giữ tên mới trong entry trả về
+    assert second.add(b'shared', 'renamed.pdf', 'application/pdf')["filename"] == 'renamed.pdf'
+
+
+def test_evicts_least_recently_used(tmp_path):
+    # Mỗi file 30 bytes → base64 40 bytes, cache chứa được 2 entry
+    cache = AttachmentCache(str(tmp_path), max_bytes=100)
+    a = cache.add(b'a' * 30, 'a', 'text/plain')["sha256"]
+    b = cache.add(b'b' * 30, 'b', 'text/plain')["sha256"]
+    _set_mtime(cache, a, 1000)
+    _set_mtime(cache, b, 2000)
+
+    # Đọc a → a thành entry mới dùng nhất, b bị loại khi thêm c
+    assert cache.get(a)
+    cache.add(b'c' * 30, 'c', 'text/plain')
+
+    assert cache.get(b) is None
+    assert cache.get(a) is not None
+    assert cache.total_bytes() == 80
+    assert not os.path.exists(cache._path(b, '.json'))
+
+
+def test_entry_larger_than_cache_is_not_stored(tmp_path):
+    cache = AttachmentCache(str(tmp_path), max_bytes=10)
+
+    entry = cache.add(b'x' * 100, 'big.bin', 'application/octet-stream')
+
+    assert entry["content_base64"]
+    assert cache.get(entry["sha256"]) is None
+    assert cache.total_bytes() == 0
@@ -0,0 +1,196 @@
+"""
+GraphService chạy với fake Graph server: circuit breaker, hedged request, timeout, thư mục archive
+"""
+import threading
+import time
+
+import pytest
+import requests
+
+import graph_service
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from log_config import request_id_var
+
+USER = 'user@example.com'
+
+
+def test_get_unread_messages(make_service):
+    service = make_service()
+
+    messages = service.get_unread_messages(USER)
+
+    assert len(messages) == 5
+    assert service.breaker.metrics() == {"state": CircuitBreaker.CLOSED, "windowRequests": 1, "windowFailures": 0}
+
+
+def test_breaker_opens_then_half_open_then_closes(make_service, fake_graph):
+    service = make_service(open_seconds=0.3)
+    fake_graph.FAULT_ERROR_RATE = 1.0
+
+    # Closed → open sau min_requests lỗi
+    for _ in range(4):
+        with pytest.raises(Exception, match='503'):
+            service.get_unread_messages(USER)
+    assert service.breaker.state == CircuitBreaker.OPEN
+
+    # Open: fail fast, không gọi tới server
+    request_count = fake_graph._request_count
+    with pytest.raises(CircuitOpenError) as error:
+        service.get_unread_messages(USER)
+    assert error.value.retry_after >= 1
+    assert fake_graph._request_count == request_count
+
+    # Hết open_seconds: chỉ một call thử được đi qua (half-open)
+    time.sleep(0.35)
+    fake_graph.FAULT_ERROR_RATE = 0
+    fake_graph.FAULT_LATENCY_MS = 300
+    trial = threading.Thread(target=service.get_unread_messages, args=(USER,))
+    trial.start()
+    time.sleep(0.1)
+    assert service.breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        service.get_unread_messages(USER)
+    trial.join()
+
+    # Call thử thành công → closed
+    assert service.breaker.state == CircuitBreaker.CLOSED
+    fake_graph.FAULT_LATENCY_MS = 0
+    assert len(service.get_unread_messages(USER)) == 5
+
+
+def test_breaker_reopens_when_trial_fails(make_service, fake_graph):
+    service = make_service(open_seconds=0.2)
+    fake_graph.FAULT_ERROR_RATE = 1.0
+    for _ in range(4):
+        with pytest.raises(Exception):
+            service.get_unread_messages(USER)
+
+    time.sleep(0.25)
+    with pytest.raises(Exception, match='503'):
+        service.get_unread_messages(USER)
+
+    assert service.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        service.get_unread_messages(USER)
+
+
+def test_read_timeout_counts_as_failure(make_service, fake_graph, monkeypatch):
+    service = make_service()
+    monkeypatch.setattr(graph_service, 'GRAPH_READ_TIMEOUT', 0.2)
+    fake_graph.FAULT_SLOW_FIRST = 1
+    fake_graph.FAULT_SLOW_MS = 1000
+
+    start = time.monotonic()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        service.get_unread_messages(USER)
+
+    assert time.monotonic() - start < 0.8
+    assert service.breaker.metrics()["windowFailures"] == 1
+
+
+def test_hedged_get_cuts_tail_latency(make_service, fake_graph):
+    service = make_service(hedge_delay_ms=100)
+    fake_graph.FAULT_SLOW_FIRST = 1
+    fake_graph.FAULT_SLOW_MS = 1500
+
+    start = time.monotonic()
+    messages = service.get_unread_messages(USER)
+
+    # Request đầu bị treo, request hedge gửi sau 100ms trả về trước
+    assert len(messages) == 5
+    assert time.monotonic() - start < 1.0
+    assert fake_graph._request_count == 2
+
+
+def test_hedged_get_keeps_request_id(make_service, fake_graph, monkeypatch):
+    service = make_service(hedge_delay_ms=50)
+    fake_graph.FAULT_SLOW_FIRST = 1
+    fake_graph.FAULT_SLOW_MS = 500
+
+    seen = []
+    send = service._send
+
+    def recording_send(*args, **kwargs):
+        seen.append((threading.current_thread().name, request_id_var.get()))
+        return send(*args, **kwargs)
+
+    monkeypatch.setattr(service, '_send', recording_send)
+    request_id_var.set('req-123')
+    service.get_unread_messages(USER)
+
+    assert [name.split('_')[0] for name, _ in seen] == ['graph-request', 'graph-hedge']
+    assert all(request_id == 'req-123' for _, request_id in seen)
+
+
+def test_first_request_not_queued_behind_hedges(make_service, fake_graph, monkeypatch):
+    monkeypatch.setattr(graph_service, 'GRAPH_HEDGE_MAX_WORKERS', 1)
+    service = make_service(hedge_delay_ms=50)
+    # Request đầu và hedge của call thứ nhất đều treo, chiếm hết thread pool hedging
+    fake_graph.FAULT_SLOW_FIRST = 2
+    fake_graph.FAULT_SLOW_MS = 1000
+    slow_call = threading.Thread(target=service.get_unread_messages, args=(USER,))
+    slow_call.start()
+    time.sleep(0.15)
+
+    start = time.monotonic()
+    assert len(service.get_unread_messages(USER)) == 5
+    assert time.monotonic() - start < 0.5
+    slow_call.join()
+    assert fake_graph._request_count == 3
+
+
+def test_no_hedge_without_delay(make_service, fake_graph):
+    service = make_service()
+
+    service.get_unread_messages(USER)
+
+    assert service._hedge_executor is None
+    assert fake_graph._request_count == 1
+
+
+def test_resolve_folder_creates_folder_once(make_service, fake_graph):
+    service = make_service()
+
+    assert service.resolve_folder_id(USER, 'Archive') == 'archive'
+    assert service.resolve_folder_id(USER, 'Đã xử lý') == 'Đã xử lý'
+    assert fake_graph._folders == {'Đã xử lý': 'Đã xử lý'}
+
+    # Lần sau lấy từ cache, không gọi Graph
+    request_count = fake_graph._request_count
+    assert service.resolve_folder_id(USER, 'Đã xử lý') == 'Đã xử lý'
+    assert fake_graph._request_count == request_count
+
+
+def test_resolve_folder_looks_up_again_on_conflict(make_service, fake_graph, monkeypatch):
+    service = make_service()
+    # Worker khác tạo thư mục ngay sau lần tìm đầu tiên
+    fake_graph._folders["Processed"] = 'processed-id'
+    find = service._find_folder_id
+    lookups = []
+
+    def racing_find(*args):
+        lookups.append(args)
+        return None if len(lookups) == 1 else find(*args)
+
+    monkeypatch.setattr(service, '_find_folder_id', racing_find)
+
+    assert service.resolve_folder_id(USER, "Processed") == 'processed-id'
+    assert len(lookups) == 2
+
+
+def test_resolve_folder_accepts_folder_id(make_service, fake_graph):
+    service = make_service()
+    fake_graph._folders["Đã xử lý"] = 'AAMkAGI2TG93AAA='
+
+    assert service.resolve_folder_id(USER, 'AAMkAGI2TG93AAA=') == 'AAMkAGI2TG93AAA='
+    # Không tạo thư mục mới mang tên folder id
+    assert fake_graph._folders == {"Đã xử lý": 'AAMkAGI2TG93AAA='}
+
+
+def test_move_messages(make_service, fake_graph):
+    service = make_service()
+
+    moved = service.move_messages(USER, ['msg-0', 'msg-1', 'missing'], 'archive')
+
+    assert moved == 2
+    assert 'msg-0' not in fake_graph._messages
@@ -0,0 +1,114 @@
+"""
+Logging: request id, sampling theo message, format trên thread listener
+"""
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+
+from fastapi.testclient import TestClient
+
+import log_config
+import main
+from log_config import ContextFilter, DeferredQueueHandler, JsonFormatter, request_id_var
+
+
+def _record(level=logging.INFO, sample_key=None, exc_info=None) -> logging.LogRecord:
+    record = logging.LogRecord('test', level, __file__, 1, 'message %s', ('x',), exc_info)
+    if sample_key is not None:
+        record.sample_key = sample_key
+    return record
+
+
+class _RecordingHandler(logging.Handler):
+    """Ghi lại record và output đã format cùng thread đã format"""
+
+    def __init__(self):
+        super().__init__()
+        self.setFormatter(JsonFormatter())
+        self.outputs = []
+
+    def emit(self, record):
+        self.outputs.append((threading.current_thread().name, record, self.format(record)))
+
+
+def test_filter_adds_request_id():
+    token = request_id_var.set('req-1')
+    try:
+        record = _record()
+        assert ContextFilter(1.0).filter(record)
+    finally:
+        request_id_var.reset(token)
+
+    assert record.request_id == 'req-1'
+    assert json.loads(JsonFormatter().format(record))["request_id"] == 'req-1'
+
+
+def test_sampling_keeps_or_drops_whole_message():
+    context_filter = ContextFilter(0.5)
+    keys = [f"msg-{index}" for index in range(1000)]
+
+    kept = {key for key in keys if context_filter.filter(_record(sample_key=key))}
+
+    # Cùng message id luôn cho cùng kết quả
+    assert kept == {key for key in keys if context_filter.filter(_record(sample_key=key))}
+    assert 350 < len(kept) < 650
+
+
+def test_sampling_never_drops_warnings_or_unkeyed_records():
+    context_filter = ContextFilter(0.0)
+
+    assert not context_filter.filter(_record(sample_key='msg-0'))
+    assert context_filter.filter(_record(level=logging.WARNING, sample_key='msg-0'))
+    assert context_filter.filter(_record())
+
+
+def test_exception_formatted_on_listener_thread():
+    log_queue = queue.SimpleQueue()
+    recording = _RecordingHandler()
+    listener = logging.handlers.QueueListener(log_queue, recording)
+    logger = logging.getLogger('test_log_config.deferred')
+    logger.propagate = False
+    handler = DeferredQueueHandler(log_queue)
+    logger.addHandler(handler)
+    listener.start()
+    try:
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception("lỗi %s", 'x', extra={"docId": "CV-1"})
+    finally:
+        listener.stop()
+        logger.removeHandler(handler)
+
+    thread_name, record, output = recording.outputs[0]
+    # Record giữ nguyên exc_info, traceback được format ở thread listener
+    assert thread_name != threading.current_thread().name
+    assert record.exc_info[0] is ValueError
+    data = json.loads(output)
+    assert data["message"] == 'lỗi x'
+    assert data["docId"] == 'CV-1'
+    assert 'ValueError: boom' in data["exc_info"]
+
+
+def test_shutdown_detaches_handler_and_setup_runs_again():
+    root = logging.getLogger()
+    log_config.setup_logging()
+    handler = log_config._queue_handler
+    assert handler in root.handlers
+
+    log_config.shutdown_logging()
+    assert handler not in root.handlers
+    assert log_config._listener is None
+
+    log_config.setup_logging()
+    assert log_config._queue_handler in root.handlers
+    assert sum(isinstance(h, DeferredQueueHandler) for h in root.handlers) == 1
+
+
+def test_request_id_header_round_trip():
+    client = TestClient(main.app)
+
+    assert client.get('/', headers={"X-Request-ID": "abc123"}).headers["X-Request-ID"] == 'abc123'
+    assert len(client.get('/').headers["X-Request-ID"]) == 16
@@ -0,0 +1,68 @@
+"""
+Lease message giữa nhiều request/worker dùng chung một file SQLite
+"""
+import threading
+import time
+
+from message_lease import MessageLeaseStore
+
+
+def test_concurrent_claims_never_overlap(tmp_path):
+    db_path = str(tmp_path / 'leases.db')
+    message_ids = [f"msg-{index}" for index in range(50)]
+    workers = 8
+    barrier = threading.Barrier(workers)
+    claimed = {}
+
+    def worker(index):
+        # Mỗi worker một store riêng, giống các process uvicorn khác nhau
+        store = MessageLeaseStore(db_path, ttl_seconds=60)
+        owner = store.new_owner()
+        barrier.wait()
+        claimed[index] = store.claim_many(message_ids, owner)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    all_claimed = [message_id for ids in claimed.values() for message_id in ids]
+    assert sorted(all_claimed) == sorted(message_ids)
+
+
+def test_release_allows_reclaim(tmp_path):
+    store = MessageLeaseStore(str(tmp_path / 'leases.db'), ttl_seconds=60)
+    first, second = store.new_owner(), store.new_owner()
+
+    assert store.claim_many(['msg-0', 'msg-1'], first) == ['msg-0', 'msg-1']
+    assert store.claim_many(['msg-0', 'msg-1'], second) == []
+
+    # Owner khác không trả được lease không phải của mình
+    store.release('msg-0', second)
+    assert store.claim_many(['msg-0'], second) == []
+
+    store.release('msg-0', first)
+    assert store.claim_many(['msg-0', 'msg-1'], second) == ['msg-0']
+
+
+def test_renew_keeps_lease_alive(tmp_path):
+    store = MessageLeaseStore(str(tmp_path / 'leases.db'), ttl_seconds=0.3)
+    first, second = store.new_owner(), store.new_owner()
+    store.claim_many(['msg-0'], first)
+
+    for _ in range(3):
+        time.sleep(0.15)
+        assert store.renew('msg-0', first)
+
+    assert store.claim_many(['msg-0'], second) == []
+
+
+def test_renew_fails_after_lease_taken(tmp_path):
+    store = MessageLeaseStore(str(tmp_path / 'leases.db'), ttl_seconds=0.1)
+    first, second = store.new_owner(), store.new_owner()
+    store.claim_many(['msg-0'], first)
+
+    time.sleep(0.15)
+    assert store.claim_many(['msg-0'], second) == ['msg-0']
+    assert not store.renew('msg-0', first)
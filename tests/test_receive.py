@@ -0,0 +1,88 @@
+"""
+Endpoint /receiveDocumentIncoming với fake Graph server
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from circuit_breaker import CircuitOpenError
+from message_lease import MessageLeaseStore
+
+HEADERS = {"X-API-Key": "test-api-key"}
+
+
+@pytest.fixture
+def client(make_service, monkeypatch, tmp_path):
+    service = make_service()
+    monkeypatch.setattr(main, 'graph_service', service)
+    # Fake server dùng lại message id giữa các test nên mỗi test một lease DB riêng
+    monkeypatch.setattr(main, 'lease_store', MessageLeaseStore(str(tmp_path / 'leases.db')))
+    monkeypatch.setattr(main, 'USER_EMAIL', 'user@example.com')
+    return TestClient(main.app)
+
+
+def _claim_all(message_ids):
+    owner = main.lease_store.new_owner()
+    claimed = main.lease_store.claim_many(message_ids, owner)
+    for message_id in claimed:
+        main.lease_store.release(message_id, owner)
+    return claimed
+
+
+def test_receive_marks_messages_read(client, fake_graph):
+    response = client.get('/receiveDocumentIncoming', headers=HEADERS)
+
+    assert response.status_code == 200
+    data = response.json()["data"]
+    assert len(data) == 5
+    assert data[0]["attachments"][0]["name"].startswith('cong-van-')
+    assert all(message['isRead'] for message in fake_graph._messages.values())
+
+
+def test_breaker_open_during_attachments_returns_503(client, fake_graph, monkeypatch):
+    def breaker_open(*args, **kwargs):
+        raise CircuitOpenError("open", 7)
+
+    monkeypatch.setattr(main.graph_service, 'get_message_attachments', breaker_open)
+
+    response = client.get('/receiveDocumentIncoming', headers=HEADERS)
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "7"
+    # Lease đã được trả, email chưa bị đánh dấu đọc
+    assert _claim_all(list(fake_graph._messages)) == list(fake_graph._messages)
+    assert not any(message['isRead'] for message in fake_graph._messages.values())
+
+
+def test_breaker_open_while_marking_returns_marked_only(client, fake_graph, monkeypatch):
+    mark_as_read = main.graph_service.mark_as_read
+    calls = []
+
+    def flaky_mark(*args):
+        calls.append(args)
+        if len(calls) > 2:
+            raise CircuitOpenError("open", 7)
+        return mark_as_read(*args)
+
+    monkeypatch.setattr(main.graph_service, 'mark_as_read', flaky_mark)
+
+    response = client.get('/receiveDocumentIncoming', headers=HEADERS)
+
+    assert response.status_code == 200
+    marked = [document["messageId"] for document in response.json()["data"]]
+    assert len(marked) == 2
+    unmarked = [message_id for message_id in fake_graph._messages if message_id not in marked]
+    assert _claim_all(unmarked) == unmarked
+
+
+def test_unexpected_error_releases_leases(client, fake_graph):
+    fake_graph._messages['msg-2']['subject'] = None
+
+    response = client.get('/receiveDocumentIncoming', headers=HEADERS)
+    assert response.status_code == 500
+
+    # Sửa dữ liệu rồi poll lại: không email nào còn bị giữ lease
+    fake_graph._messages['msg-2']['subject'] = 'Công văn số 2'
+    response = client.get('/receiveDocumentIncoming', headers=HEADERS)
+    assert response.status_code == 200
+    assert response.json()["length"] == 5
@@ -0,0 +1,74 @@
+"""
+Warm-up khi khởi động, /ready và vòng đời connection pool qua nhiều lần lifespan
+"""
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from message_lease import MessageLeaseStore
+
+HEADERS = {"X-API-Key": "test-api-key"}
+
+
+@pytest.fixture
+def app_service(make_service, monkeypatch, tmp_path):
+    service = make_service(hedge_delay_ms=50)
+    monkeypatch.setattr(main, 'graph_service', service)
+    monkeypatch.setattr(main, 'USER_EMAIL', 'user@example.com')
+    monkeypatch.setattr(main, 'lease_store', MessageLeaseStore(str(tmp_path / 'leases.db')))
+    monkeypatch.setitem(main.readiness_state, "ready", False)
+    monkeypatch.setitem(main.readiness_state, "last_attempt", 0.0)
+    return service
+
+
+def test_lifespan_can_run_again(app_service, fake_graph):
+    for _ in range(2):
+        with TestClient(main.app) as client:
+            assert client.get('/ready').status_code == 200
+            # Hedged GET vẫn chạy được sau khi lifespan trước đã close thread pool
+            response = client.get('/receiveDocumentIncoming', headers=HEADERS)
+            assert response.status_code == 200
+        assert app_service.session is None
+        assert not main.readiness_state["ready"]
+
+
+def test_ready_retries_at_most_once_per_interval(app_service, fake_graph, monkeypatch):
+    monkeypatch.setattr(main, 'READY_RETRY_INTERVAL_SECONDS', 0.3)
+    fake_graph.FAULT_ERROR_RATE = 1.0
+    client = TestClient(main.app)
+
+    for _ in range(5):
+        response = client.get('/ready')
+        assert response.status_code == 503
+        # Không trả chi tiết lỗi của Graph/MSAL cho client
+        assert response.json() == {"status": "not_ready"}
+    assert fake_graph._request_count == 1
+
+    # Hết khoảng cách tối thiểu và Graph đã hồi phục → ready
+    fake_graph.FAULT_ERROR_RATE = 0
+    time.sleep(0.35)
+    assert client.get('/ready').status_code == 200
+    assert client.get('/ready').status_code == 200
+    assert fake_graph._request_count == 2
+
+
+def test_concurrent_warm_up_calls_graph_once(app_service, monkeypatch):
+    calls = []
+
+    def slow_warm_up(user_email):
+        calls.append(user_email)
+        time.sleep(0.2)
+
+    monkeypatch.setattr(app_service, 'warm_up', slow_warm_up)
+
+    threads = [threading.Thread(target=main.warm_up, args=(True,)) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert main.readiness_state["ready"]